@@ -0,0 +1,175 @@
+# Streaming statistics of every reading, updated as frames arrive.
+#
+# For each key (the app uses (device_id, metric)) an Aggregator keeps
+#   - exponential moving averages with time constants instead of a fixed
+#     alpha per call: a sample after dt seconds weighs 1 - exp(-dt / tau),
+#     so the average means the same whatever the sample rate is
+#   - count, min, max and mean over sliding windows (1 min, 5 min, 1 h)
+#
+# Each sample costs O(1) amortized: a window holds its samples in a deque
+# with a running sum, and min and max come from monotonic deques whose
+# heads are the extremes. Reads take a snapshot under the same lock.
+
+import math
+import threading
+import time
+from collections import deque
+
+# Seconds
+DEFAULT_WINDOWS = (60, 300, 3600)
+# Seconds; 300 s is close to the old alpha = 0.2 at one sample per minute
+DEFAULT_TIME_CONSTANTS = (60, 300)
+
+
+def label(seconds):
+    # 60 -> '1m', 3600 -> '1h', 90 -> '90s'
+    for unit, size in (('h', 3600), ('m', 60)):
+        if seconds % size == 0:
+            return f'{seconds // size}{unit}'
+    return f'{seconds}s'
+
+
+class TimeEMA:
+
+    def __init__(self, tau):
+        self.tau = tau
+        self.value = None
+        self.time = None
+
+    def add(self, value, timestamp):
+        if self.value is None:
+            self.value = value
+        elif timestamp > self.time:
+            weight = 1 - math.exp((self.time - timestamp) / self.tau)
+            self.value += weight * (value - self.value)
+        self.time = timestamp if self.time is None else max(self.time, timestamp)
+
+
+class Window:
+    # Count, min, max and mean of the samples of the last `seconds`. Samples
+    # are expected in time order, as they arrive.
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._samples = deque()
+        # (time, value) with increasing values, resp. decreasing values
+        self._min = deque()
+        self._max = deque()
+        self._sum = 0.0
+
+    def add(self, value, timestamp):
+        self._samples.append((timestamp, value))
+        self._sum += value
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((timestamp, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((timestamp, value))
+        self.expire(timestamp)
+
+    def expire(self, now):
+        start = now - self.seconds
+        samples = self._samples
+        while samples and samples[0][0] <= start:
+            self._sum -= samples.popleft()[1]
+        if not samples:
+            # No rounding error carried over from long gone samples
+            self._sum = 0.0
+        while self._min and self._min[0][0] <= start:
+            self._min.popleft()
+        while self._max and self._max[0][0] <= start:
+            self._max.popleft()
+
+    def stats(self):
+        if not self._samples:
+            return None
+        count = len(self._samples)
+        return {'count': count, 'min': self._min[0][1], 'max': self._max[0][1], 'mean': self._sum / count}
+
+
+class _Series:
+
+    def __init__(self, windows, time_constants):
+        self.emas = [TimeEMA(tau) for tau in time_constants]
+        self.windows = [Window(seconds) for seconds in windows]
+        self.last = None
+        # Time of the newest sample
+        self.time = None
+
+
+class Aggregator:
+
+    def __init__(self, windows=DEFAULT_WINDOWS, time_constants=DEFAULT_TIME_CONSTANTS):
+        self.windows = tuple(windows)
+        self.time_constants = tuple(time_constants)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series(self.windows, self.time_constants)
+        return series
+
+    def add(self, key, value, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            series = self._get(key)
+            series.last = value
+            series.time = timestamp if series.time is None else max(series.time, timestamp)
+            for ema in series.emas:
+                ema.add(value, timestamp)
+            for window in series.windows:
+                window.add(value, timestamp)
+
+    def seed(self, key, value, timestamp):
+        # Start the averages of a new key from an earlier value, e.g. the last
+        # row in the database; it fades out with its age
+        with self._lock:
+            series = self._get(key)
+            for ema in series.emas:
+                if ema.value is None:
+                    ema.add(value, timestamp)
+
+    def keys(self, since=None):
+        # Keys with at least one sample, or with one at or after `since`;
+        # seed() alone does not add one
+        with self._lock:
+            return [key for key, series in self._series.items()
+                    if series.time is not None and (since is None or series.time >= since)]
+
+    def ema(self, key, tau=None):
+        # The moving average with time constant `tau` (default: the longest)
+        tau = max(self.time_constants) if tau is None else tau
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                return None
+            return series.emas[self.time_constants.index(tau)].value
+
+    def window(self, key, seconds, now=None):
+        # Count, min, max and mean over the window of `seconds`, or None
+        now = time.time() if now is None else now
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                return None
+            window = series.windows[self.windows.index(seconds)]
+            window.expire(now)
+            return window.stats()
+
+    def snapshot(self, key, now=None):
+        # {'last': value, 'ema': {'5m': ...}, 'windows': {'1m': stats or None, ...}}
+        now = time.time() if now is None else now
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                return None
+            windows = {}
+            for window in series.windows:
+                window.expire(now)
+                windows[label(window.seconds)] = window.stats()
+            return {'last': series.last,
+                    'ema': {label(ema.tau): ema.value for ema in series.emas},
+                    'windows': windows}
@@ -10,7 +10,8 @@ app = Flask(__name__)
 # Function to fetch and store data
 def fetch_sensor_data():
     global sensor_data
-    sensor_data = get_all('/dev/hidraw0')
+    # The first CO2 monitor that is plugged in
+    sensor_data = get_all()
 
 # Initially fetch data
 fetch_sensor_data()
@@ -26,8 +27,9 @@ atexit.register(lambda: scheduler.shutdown())
 @app.route('/')
 def index():
     # Render the HTML template with the last fetched sensor data
-    temperature = round(sensor_data['Temperature'], 2)
-    co2 = sensor_data['CO2']
+    # get_all() gives up after 10 s; a value it did not get is None
+    temperature = round(sensor_data['Temperature'], 2) if sensor_data['Temperature'] is not None else 'N/A'
+    co2 = sensor_data['CO2'] if sensor_data['CO2'] is not None else 'N/A'
     html_template = """
     <!DOCTYPE html>
     <html>
@@ -0,0 +1,308 @@
+#!/usr/bin/python3 -u
+# Benchmark suite for the decode, ingest, query and render paths.
+#
+#   python3 bench.py [--only decode get_all insert query endpoints]
+#                    [--sizes 10k,1M,10M] [--output results.json]
+#
+# Prints one JSON document, so runs can be stored and compared across
+# changes. Everything runs without hardware: the monitor is a recording
+# replayed on a pty (replay.py) and the databases are synthetic. They are
+# kept in --data-dir, because building the 10M row one takes a while.
+# Timings are in milliseconds unless a key says otherwise.
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import storage
+
+# Synthetic databases hold one year of rows; more rows means denser samples
+SYNTHETIC_SPAN = 365 * 86400
+
+# Ranges queried on each synthetic database, in hours
+QUERY_HOURS = (1, 24, 24 * 7, 24 * 30, 24 * 365)
+
+ENDPOINTS = (
+    '/',
+    '/client',
+    '/plot/co2',
+    '/plot/temperature?hours=720',
+    '/api/series?metric=co2&hours=24',
+    '/api/series?metric=co2&hours=24&format=bin',
+    '/api/series?metric=co2&hours=8760&format=bin',
+)
+
+# App variants measured by bench_endpoints, none of them touching hardware:
+# name -> (factory name in monitor_app, sensor specs). 'web' is a
+# create_web_app() worker before ingest.py has published anything.
+APPS = {
+    'app': ('create_app', ['simulated']),
+    'app_co2': ('create_app', ['co2', 'dht22']),
+    'web': ('create_web_app', ['co2', 'dht22']),
+}
+
+
+def parse_size(text):
+    # '10k' -> 10000, '1M' -> 1000000
+    factor = {'k': 10 ** 3, 'M': 10 ** 6}.get(text[-1], 1)
+    return int(float(text.rstrip('kM')) * factor)
+
+
+def measure(func, repeat=5):
+    # Runs func() `repeat` times; returns millisecond statistics
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': statistics.median(timings), 'min_ms': min(timings),
+            'max_ms': max(timings), 'runs': repeat}
+
+
+def metadata():
+    import subprocess
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'time': time.time(), 'commit': commit, 'python': platform.python_version(),
+            'machine': platform.machine(), 'platform': platform.platform(),
+            'sqlite': storage.sqlite3.sqlite_version}
+
+
+def bench_decode(frames=20000):
+    import bench_decoder
+
+    return bench_decoder.run(frames)
+
+
+def _drain(device):
+    # Drop frames the replay buffered while nobody was reading
+    fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK | os.O_NOCTTY)
+    try:
+        while True:
+            try:
+                if not os.read(fd, 4096):
+                    return
+            except BlockingIOError:
+                return
+    finally:
+        os.close(fd)
+
+
+def bench_get_all(workdir, speed=100.0, repeat=5):
+    # read_all() latency on a replayed device, and CO2Reader.get_all() from memory
+    import mod_co2modnitor
+    import replay
+
+    recording = os.path.join(workdir, 'frames.co2')
+    if not os.path.exists(recording):
+        replay.generate(recording, hours=1, seed=1)
+
+    ready = threading.Event()
+    device = []
+
+    def on_ready(path):
+        device.append(path)
+        ready.set()
+
+    threading.Thread(target=replay.serve, args=(recording, speed, True), kwargs={'ready': on_ready},
+                     name='replay', daemon=True).start()
+    ready.wait()
+    device = device[0]
+
+    def read_all():
+        _drain(device)
+        mod_co2modnitor.read_all(device, timeout=10)
+
+    results = {'speed': speed, 'read_all': measure(read_all, repeat)}
+    # At real speed a read waits about `speed` times longer
+    results['read_all']['real_time_median_ms'] = results['read_all']['median_ms'] * speed
+
+    reader = mod_co2modnitor.CO2Reader(device).start()
+    reader.wait(10)
+    calls = 10000
+    timing = measure(lambda: [reader.get_all() for _ in range(calls)], repeat=3)
+    reader.stop()
+    results['CO2Reader.get_all_us'] = timing['median_ms'] * 1000 / calls
+    return results
+
+
+def bench_insert(workdir, rows=2000, batch=100):
+    # Rows per second (raw row plus rollups) through insert_measurement(), one
+    # transaction per row, and through BatchWriter flushes of `batch` rows,
+    # the write path of the app's write_sensor_data()
+    path = os.path.join(workdir, 'insert.db')
+    results = {'rows': rows, 'batch': batch}
+    now = time.time() - rows * 300
+    for name in ('single', 'batched'):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        writer = storage.BatchWriter(path, max_rows=batch)
+        start = time.perf_counter()
+        for i in range(rows):
+            if name == 'single':
+                storage.insert_measurement(21.0, 600.0 + i % 100, 45.0, timestamp=now + i * 300, path=path)
+            else:
+                writer.add(21.0, 600.0 + i % 100, 45.0, timestamp=now + i * 300)
+                if writer.pending() >= batch:
+                    writer.flush()
+        writer.flush()
+        seconds = time.perf_counter() - start
+        results[name] = {'rows_per_second': rows / seconds, 'ms_per_row': seconds * 1000 / rows}
+        storage.close_all()
+    return results
+
+
+def synthetic_db(path, rows):
+    # One device, `rows` rows evenly spread over SYNTHETIC_SPAN up to now, with rollups
+    if os.path.exists(path):
+        return path
+    import numpy as np
+
+    conn = storage.connect(path + '.tmp')
+    storage.migrate(conn)
+    now = int(time.time())
+    times = np.linspace(now - SYNTHETIC_SPAN, now, rows).astype(np.int64)
+    rng = np.random.default_rng(rows)
+    co2 = 600 + np.cumsum(rng.normal(0, 5, rows)) % 800
+    conn.execute('BEGIN')
+    # In chunks, so 10M rows don't become 40M Python objects at once
+    chunk = 100000
+    for start in range(0, rows, chunk):
+        t = times[start:start + chunk]
+        day = np.sin(2 * np.pi * (t % 86400) / 86400)
+        temperature = 21 + 2 * day + rng.normal(0, 0.1, len(t))
+        humidity = 45 - 5 * day + rng.normal(0, 0.5, len(t))
+        conn.executemany('INSERT INTO measurements (time, temperature, co2, humidity, device_id) '
+                         "VALUES (?, ?, ?, ?, 'bench')",
+                         zip(t.tolist(), temperature.tolist(), co2[start:start + chunk].tolist(),
+                             humidity.tolist()))
+    storage.rebuild_rollups(conn)
+    conn.commit()
+    conn.close()
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def bench_query(data_dir, sizes, repeat=5):
+    results = {}
+    for size in sizes:
+        rows = parse_size(size)
+        start = time.perf_counter()
+        path = synthetic_db(os.path.join(data_dir, f'synthetic-{size}.db'), rows)
+        size_results = {'rows': rows, 'build_seconds': time.perf_counter() - start}
+        for hours in QUERY_HOURS:
+            since = time.time() - hours * 3600
+            resolution = storage.query_series_arrays('co2', since, path=path)[0]
+            size_results[f'{hours}h'] = dict(
+                measure(lambda: storage.query_series_arrays('co2', since, path=path), repeat),
+                resolution=resolution)
+        # The full-resolution path, as before rollups existed
+        since = time.time() - 24 * 3600
+        size_results['24h_raw'] = measure(
+            lambda: storage.query_series_arrays('co2', since, resolution='raw', path=path), repeat)
+        results[size] = size_results
+    storage.close_all()
+    return results
+
+
+def _get(client, url, **kwargs):
+    response = client.get(url, **kwargs)
+    if response.status_code not in (200, 304):
+        raise RuntimeError(f"GET {url} answered {response.status_code}")
+    return response
+
+
+def make_app(name, workdir):
+    import monitor_app
+
+    factory, specs = APPS[name]
+    if factory == 'create_web_app':
+        return monitor_app.create_web_app(specs, state_path=os.path.join(workdir, 'no-state'))
+    return monitor_app.create_app(specs, start_sensors=False)
+
+
+def bench_endpoints(data_dir, size, repeat=5):
+    # Latency of the app's pages through Flask's test client on a synthetic
+    # database, for each of APPS; sensors are not started. Fails on any
+    # response other than 200 or 304.
+    workdir = tempfile.mkdtemp(prefix='bench-app-')
+    cwd = os.getcwd()
+    try:
+        shutil.copy(synthetic_db(os.path.join(data_dir, f'synthetic-{size}.db'), parse_size(size)),
+                    os.path.join(workdir, storage.DB_PATH))
+        os.chdir(workdir)
+        import plotting
+
+        results = {'rows': parse_size(size)}
+        for name in APPS:
+            client = make_app(name, workdir).test_client()
+            app_results = results[name] = {}
+            for url in ENDPOINTS:
+                def cold():
+                    plotting.plot_cache.clear()
+                    _get(client, url)
+                app_results[url] = {'cold': measure(cold, repeat), 'warm': measure(lambda: _get(client, url), repeat)}
+                etag = _get(client, url).headers.get('ETag')
+                if etag:
+                    app_results[url]['not_modified'] = measure(
+                        lambda: _get(client, url, headers={'If-None-Match': etag}), repeat)
+        return results
+    finally:
+        os.chdir(cwd)
+        storage.close_all()
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark decode, ingest, query and render paths')
+    parser.add_argument('--only', nargs='+', choices=('decode', 'get_all', 'insert', 'query', 'endpoints'),
+                        help='run only these benchmarks')
+    parser.add_argument('--sizes', default='10k,1M,10M', help='synthetic database sizes for the query benchmark')
+    parser.add_argument('--endpoint-size', default='1M', help='synthetic database size for the endpoints')
+    parser.add_argument('--speed', type=float, default=100.0, help='replay speed-up for get_all')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'co2-bench'),
+                        help='where synthetic databases are kept between runs')
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    selected = args.only or ('decode', 'get_all', 'insert', 'query', 'endpoints')
+    benchmarks = {
+        'decode': lambda: bench_decode(),
+        'get_all': lambda: bench_get_all(args.data_dir, args.speed, args.repeat),
+        'insert': lambda: bench_insert(args.data_dir),
+        'query': lambda: bench_query(args.data_dir, args.sizes.split(','), args.repeat),
+        'endpoints': lambda: bench_endpoints(args.data_dir, args.endpoint_size, args.repeat),
+    }
+
+    results = {'meta': metadata()}
+    # Keep stdout for the JSON; progress and migration messages go to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        for name in selected:
+            print(f"Running {name} ...")
+            results[name] = benchmarks[name]()
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python3 -u
+# Micro-benchmark: frames/second of the original decrypt() from co2monitor.py
+# against the table-driven decoder in co2_decoder.py.
+#
+#   python3 bench_decoder.py [--frames 20000] [--slowdown 15]
+#
+# The monitor only sends a few frames per second, so the interesting number
+# on a Pi Zero is the share of one core the decoder needs at that rate.
+# Run it on the Pi itself, or pass --slowdown to scale desktop timings
+# (a Pi Zero W core is roughly 10-20x slower than a current desktop core).
+
+import argparse
+import os
+import time
+
+import co2monitor
+from co2_decoder import FrameDecoder, KEY
+
+
+def _time_per_frame(func, frames, repeat=3):
+    # Best of `repeat` runs, in seconds per frame
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(frames)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(frames)
+
+
+def run(n_frames=20000, frame_rate=10.0, slowdown=1.0):
+    frames = [os.urandom(8) for _ in range(n_frames)]
+    key = list(KEY)
+    decoder = FrameDecoder(KEY)
+
+    def reference(frames):
+        for f in frames:
+            co2monitor.decrypt(key, list(f))
+
+    def table(frames):
+        for f in frames:
+            decoder.decrypt(f)
+
+    def table_decode(frames):
+        for f in frames:
+            decoder.decode(f)
+
+    cases = [('co2monitor.decrypt', reference),
+             ('FrameDecoder.decrypt', table),
+             ('FrameDecoder.decode', table_decode)]
+
+    try:
+        import numpy  # noqa: F401
+        blob = b''.join(frames)
+        cases.append(('FrameDecoder.decrypt_many', lambda frames: decoder.decrypt_many(blob)))
+    except ImportError:
+        pass
+
+    results = {}
+    for name, func in cases:
+        per_frame = _time_per_frame(func, frames) * slowdown
+        results[name] = {
+            'frames_per_second': 1.0 / per_frame,
+            'us_per_frame': per_frame * 1e6,
+            # Share of one core needed to keep up with the monitor
+            'cpu_percent_at_frame_rate': 100.0 * per_frame * frame_rate,
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark CO2 monitor frame decoding')
+    parser.add_argument('--frames', type=int, default=20000)
+    parser.add_argument('--frame-rate', type=float, default=10.0,
+                        help='frames per second sent by the monitor')
+    parser.add_argument('--slowdown', type=float, default=1.0,
+                        help='scale timings to approximate a slower CPU')
+    args = parser.parse_args()
+
+    results = run(args.frames, args.frame_rate, args.slowdown)
+    baseline = results['co2monitor.decrypt']['frames_per_second']
+    print("%-28s %14s %10s %8s %10s" % ("decoder", "frames/s", "us/frame", "speedup", "cpu@rate"))
+    for name, r in results.items():
+        print("%-28s %14.0f %10.2f %7.1fx %9.3f%%" % (
+            name, r['frames_per_second'], r['us_per_frame'],
+            r['frames_per_second'] / baseline, r['cpu_percent_at_frame_rate']))
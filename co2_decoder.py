@@ -0,0 +1,119 @@
+# Table-driven decoder for the 8-byte frames sent by the TFA/AirCO2ntrol monitor.
+#
+# decrypt() in co2monitor.py unshuffles the bytes, XORs them with the key,
+# rotates the whole frame right by three bits and subtracts a constant
+# derived from cstate from every byte. All of that only depends on the key,
+# so everything that can be is computed once in FrameDecoder.__init__ and a
+# frame is then decoded with a handful of integer operations on a single
+# 64-bit value, without building any intermediate lists.
+
+from operator import itemgetter
+
+KEY = (0xc4, 0xc6, 0xc0, 0x92, 0x40, 0x23, 0xdc, 0x96)
+CSTATE = (0x48, 0x74, 0x65, 0x6D, 0x70, 0x39, 0x39, 0x65)
+SHUFFLE = (2, 4, 0, 7, 1, 6, 5, 3)
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+_HIGH_BITS = 0x8080808080808080
+
+
+def _as_frames(frames):
+    import numpy as np
+
+    if isinstance(frames, (bytes, bytearray, memoryview)):
+        frames = np.frombuffer(frames, dtype=np.uint8)
+    return np.asarray(frames, dtype=np.uint8).reshape(-1, 8)
+
+
+def is_valid(frame):
+    # A decoded frame is op, value high, value low, checksum, 0x0d
+    return frame[4] == 0x0d and (frame[0] + frame[1] + frame[2]) & 0xff == frame[3]
+
+
+def make_frame(op, value):
+    # Decoded frame for one value, as the monitor would send it
+    high, low = (value >> 8) & 0xff, value & 0xff
+    return bytes((op, high, low, (op + high + low) & 0xff, 0x0d, 0, 0, 0))
+
+
+class FrameDecoder:
+
+    def __init__(self, key=KEY):
+        self.key = bytes(key)
+
+        # phase1[SHUFFLE[i]] = data[i], i.e. phase1[o] = data[inverse[o]]
+        inverse = [0] * 8
+        for i, o in enumerate(SHUFFLE):
+            inverse[o] = i
+        self._inverse = tuple(inverse)
+        self._unshuffle = itemgetter(*inverse)
+        self._shuffle = itemgetter(*SHUFFLE)
+        self._key_int = int.from_bytes(self.key, 'big')
+
+        ctmp = bytes(((c >> 4) | (c << 4)) & 0xff for c in CSTATE)
+        self._ctmp = ctmp
+        self._ctmp_int = int.from_bytes(ctmp, 'big')
+        # Per-byte subtraction without borrows between lanes (SWAR):
+        # (x | H) - (c & ~H) never borrows across a byte, the top bits are fixed up after
+        self._ctmp_low = self._ctmp_int & ~_HIGH_BITS & _MASK64
+        self._ctmp_not = ~self._ctmp_int & _MASK64
+
+    def decrypt(self, data):
+        # Returns the 8 decrypted bytes of one frame as a bytes object
+        x = int.from_bytes(bytes(self._unshuffle(data)), 'big') ^ self._key_int
+        x = ((x >> 3) | (x << 61)) & _MASK64
+        x = ((x | _HIGH_BITS) - self._ctmp_low) ^ ((x ^ self._ctmp_not) & _HIGH_BITS)
+        return x.to_bytes(8, 'big')
+
+    def encrypt(self, frame):
+        # Inverse of decrypt(), for recordings made up by replay.py
+        x = int.from_bytes(bytes(frame), 'big')
+        # Per-byte addition without carries between lanes
+        x = ((x & ~_HIGH_BITS) + self._ctmp_low) ^ ((x ^ self._ctmp_int) & _HIGH_BITS)
+        x = (((x << 3) | (x >> 61)) & _MASK64) ^ self._key_int
+        return bytes(self._shuffle(x.to_bytes(8, 'big')))
+
+    def decode(self, data):
+        # Some monitors send frames unencrypted; only decrypt when needed.
+        # Returns the decoded frame or None if the checksum does not match.
+        if not is_valid(data):
+            data = self.decrypt(data)
+            if not is_valid(data):
+                return None
+        return data
+
+    def decrypt_many(self, frames):
+        # Vectorized decrypt for replaying captured logs. `frames` is anything
+        # numpy can view as uint8 (bytes of N*8 length or an (N, 8) array);
+        # returns an (N, 8) uint8 array.
+        import numpy as np
+
+        frames = _as_frames(frames)
+        phase2 = frames[:, self._inverse] ^ np.frombuffer(self.key, dtype=np.uint8)
+        phase3 = (phase2 >> 3) | (np.roll(phase2, 1, axis=1) << 5)
+        return phase3 - np.frombuffer(self._ctmp, dtype=np.uint8)
+
+    def decode_many(self, frames):
+        # Like decode() for N frames at once. Returns (decoded, valid) where
+        # `valid` is a boolean mask of frames that passed the checksum.
+        import numpy as np
+
+        raw = _as_frames(frames)
+
+        def checksum_ok(f):
+            return (f[:, 4] == 0x0d) & ((f[:, :3].sum(axis=1, dtype=np.uint16) & 0xff) == f[:, 3])
+
+        plain = checksum_ok(raw)
+        decoded = np.where(plain[:, None], raw, self.decrypt_many(raw))
+        return decoded, checksum_ok(decoded)
+
+
+_default_decoder = FrameDecoder()
+
+
+def decrypt(data):
+    return _default_decoder.decrypt(data)
+
+
+def decode(data):
+    return _default_decoder.decode(data)
@@ -2,6 +2,9 @@
 
 import sys, fcntl, time
 
+from co2_decoder import FrameDecoder
+
+# Original per-byte implementation, kept as the reference for co2_decoder
 def decrypt(key,  data):
 	cstate = [0x48,  0x74,  0x65,  0x6D,  0x70,  0x39,  0x39,  0x65]
 	shuffle = [2, 4, 0, 7, 1, 6, 5, 3]
@@ -47,14 +50,15 @@ if __name__ == "__main__":
 	fcntl.ioctl(fp, HIDIOCSFEATURE_9, set_report)
 	
 	values = {}
+	decoder = FrameDecoder(key)
 	
 	while True:
-		data = list(fp.read(8))
+		data = fp.read(8)
 		decrypted = None
 		if data[4] == 0x0d and (sum(data[:3]) & 0xff) == data[3]:
 			decrypted = data
 		else:
-			decrypted = decrypt(key, data)
+			decrypted = decoder.decrypt(data)
 
 		if decrypted[4] != 0x0d or (sum(decrypted[:3]) & 0xff) != decrypted[3]:
 			 print (hd(data), " => ", hd(decrypted),  "Checksum error")
@@ -1,21 +1,14 @@
-import sqlite3
+import sys
 
-# Connect to the SQLite database (it will be created if it doesn't exist)
-conn = sqlite3.connect('sensor_data.db')
+import storage
 
-# Create a cursor object using the cursor method
-cursor = conn.cursor()
+# Creates sensor_data.db, or migrates an existing database (including the
+# old TEXT-time schema without a humidity column) to the current schema.
+#   python3 create_sqlite_db.py [path/to/sensor_data.db]
+path = sys.argv[1] if len(sys.argv) > 1 else storage.DB_PATH
 
-# Create table
-cursor.execute('''
-               CREATE TABLE IF NOT EXISTS measurements (
-               time TEXT,
-               temperature REAL,
-               co2 INTEGER
-                )
-               ''')
-
-# Commit the changes and close the connection
-conn.commit()
+conn = storage.connect(path)
+version = storage.migrate(conn)
 conn.close()
 
+print(f"{path} is at schema version {version}")
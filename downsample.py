@@ -0,0 +1,72 @@
+# Reduce a time series to roughly as many points as the chart has pixels.
+#
+# lttb_indices() implements Largest-Triangle-Three-Buckets: it keeps the
+# point of each bucket that spans the largest triangle with its neighbours,
+# which preserves the shape of the curve and keeps short CO2 spikes that
+# averaging would flatten. minmax_indices() is the cheaper alternative
+# that keeps the lowest and highest point of every bucket.
+
+import numpy as np
+
+
+def lttb_indices(x, y, n_out):
+    # Indices of the points to keep, always including the first and last
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # n_out - 2 buckets between the fixed first and last point
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    keep = np.empty(n_out, dtype=np.intp)
+    keep[0], keep[-1] = 0, n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # The third triangle corner is the average of the next bucket
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a])
+                      - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        keep[i + 1] = a
+    return keep
+
+
+def minmax_indices(y, n_out):
+    # Indices of the minimum and maximum of n_out / 2 equal buckets
+    n = len(y)
+    if n_out >= n or n_out < 2:
+        return np.arange(n)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(0, n, n_out // 2 + 1).astype(np.intp)
+    keep = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end > start:
+            bucket = y[start:end]
+            keep += [start + int(bucket.argmin()), start + int(bucket.argmax())]
+    return np.unique(keep)
+
+
+def downsample(times, means, lows=None, highs=None, n_out=640, method='lttb'):
+    # Downsample a series to about n_out points. When min/max columns are
+    # given, each kept point gets the min/max from itself up to the next kept
+    # point, so the band still covers every sample.
+    times = np.asarray(times)
+    means = np.asarray(means)
+    if n_out is None or len(times) <= n_out:
+        return times, means, lows, highs
+
+    if method == 'minmax':
+        keep = minmax_indices(means, n_out)
+    else:
+        keep = lttb_indices(times, means, n_out)
+
+    if lows is not None:
+        lows = np.minimum.reduceat(np.asarray(lows), keep)
+    if highs is not None:
+        highs = np.maximum.reduceat(np.asarray(highs), keep)
+    return times[keep], means[keep], lows, highs
@@ -1,37 +1,128 @@
+import atexit
+import threading
 import time
-import board
-import adafruit_dht
 
-def get_temp_humidity():
-    max_attempts = 20  # 20 attempts, each with a 0.1-second delay will cover 2 seconds
+import metrics
+
+# The DHT22 needs about 2 seconds between measurements; asking sooner
+# just returns the previous values (or fails).
+MIN_READ_INTERVAL = 2.0
+
+ATTEMPTS = metrics.Counter('dht22_read_attempts_total', 'Single DHT22 measurements attempted')
+ERRORS = metrics.Counter('dht22_read_errors_total', 'DHT22 attempts that failed (checksum, missed pulses)')
+FAILURES = metrics.Counter('dht22_read_failures_total', 'DHT22 reads that gave up after all retries')
+READ_SECONDS = metrics.Histogram('dht22_read_seconds', 'Time for a DHT22 read including retries')
+
+
+class DHT22Reader:
+    # Keeps one adafruit_dht.DHT22 instance for the life of the process
+    # instead of rebuilding the driver (and re-claiming the pin) per attempt.
+
+    def __init__(self, pin='D14', min_interval=MIN_READ_INTERVAL, max_wait=8.0,
+                 backoff=1.5, max_age=300.0):
+        self.pin = pin
+        self.min_interval = min_interval
+        # Give up retrying after this many seconds per read()
+        self.max_wait = max_wait
+        self.backoff = backoff
+        # Fall back to the cached reading if it is at most this old
+        self.max_age = max_age
+        self._device = None
+        self._lock = threading.Lock()
+        self._last_attempt = None
+        self._last_good = None
+        self._last_good_time = None
+
+    def _get_device(self):
+        # Hardware libraries are only imported (and the pin claimed) on first use
+        if self._device is None:
+            import board
+            import adafruit_dht
+            self._device = adafruit_dht.DHT22(getattr(board, self.pin))
+        return self._device
+
+    def _wait_for_sensor(self, gap=0.0):
+        # Sleep until `gap` seconds, and at least min_interval, after the last attempt
+        if self._last_attempt is not None:
+            remaining = self._next_attempt(gap) - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+        self._last_attempt = time.monotonic()
+
+    def _next_attempt(self, gap):
+        return self._last_attempt + max(gap, self.min_interval)
 
-    for attempt in range(max_attempts):
-        # Initialize the DHT22 sensor on GPIO14 within the loop
-        dhtDevice = adafruit_dht.DHT22(board.D14)
+    def last_reading(self):
+        # Returns (reading, age in seconds) of the last good reading, or (None, None)
+        if self._last_good is None:
+            return None, None
+        return self._last_good, time.monotonic() - self._last_good_time
 
-        try:
-            # Try to get the temperature and humidity readings
-            temperature = dhtDevice.temperature
-            humidity = dhtDevice.humidity
+    def read(self):
+        with self._lock:
+            reading, age = self.last_reading()
+            if reading is not None and age < self.min_interval:
+                return reading
 
-            # Check if readings are valid and return them as a dictionary
-            if humidity is not None and temperature is not None:
-                return {'temperature': round(temperature, 2), 'humidity': round(humidity, 2)}
+            device = self._get_device()
+            with READ_SECONDS.time():
+                return self._read_with_retries(device)
 
-        except RuntimeError as error:
-            # Print the error and retry after 0.1 seconds
-            print(f"Attempt {attempt + 1}: Error reading data from the DHT sensor:", error.args[0])
-            time.sleep(0.1)
+    def _read_with_retries(self, device):
+        deadline = time.monotonic() + self.max_wait
+        # Seconds from one attempt to the next: min_interval, then growing by backoff
+        delay = 0.0
+        attempt = 0
+        while True:
+            attempt += 1
+            self._wait_for_sensor(delay)
+            ATTEMPTS.inc()
+            try:
+                temperature = device.temperature
+                humidity = device.humidity
+                if humidity is not None and temperature is not None:
+                    self._last_good = {'temperature': round(temperature, 2), 'humidity': round(humidity, 2)}
+                    self._last_good_time = time.monotonic()
+                    return self._last_good
+            except RuntimeError as error:
+                ERRORS.inc()
+                # Checksum errors and missed pulses are common with the DHT22
+                print(f"Attempt {attempt}: Error reading data from the DHT sensor:", error.args[0])
 
-        finally:
-            # Ensure the sensor is properly cleaned up after each attempt
-            dhtDevice.exit()
+            # Back off before the next attempt, within the overall deadline
+            delay = self.min_interval if attempt == 1 else delay * self.backoff
+            if self._next_attempt(delay) > deadline:
+                break
 
-    # If all attempts fail, return None values
-    print("Failed to retrieve data from humidity sensor after multiple attempts.")
-    return {'temperature': None, 'humidity': None}
+        FAILURES.inc()
+        print("Failed to retrieve data from humidity sensor after multiple attempts.")
+        reading, age = self.last_reading()
+        if reading is not None and age <= self.max_age:
+            return reading
+        return {'temperature': None, 'humidity': None}
+
+    def close(self):
+        if self._device is not None:
+            self._device.exit()
+            self._device = None
+
+
+_default_reader = None
+
+
+def get_dht22_reader():
+    global _default_reader
+    if _default_reader is None:
+        _default_reader = DHT22Reader()
+        atexit.register(_default_reader.close)
+    return _default_reader
+
+
+def get_temp_humidity():
+    return get_dht22_reader().read()
 
-# Example of using the function
-sensor_data = get_temp_humidity()
-print(sensor_data)
 
+if __name__ == '__main__':
+    # Example of using the function
+    sensor_data = get_temp_humidity()
+    print(sensor_data)
@@ -0,0 +1,78 @@
+# Standalone ingest process: owns the sensors and the database writes, and
+# publishes the latest values for the web workers.
+#
+#   python3 ingest.py --sensors co2 dht22 [--state PATH] [--metrics-port 9101]
+#   MONITOR_SENSORS="co2 dht22" gunicorn -w 4 "monitor_app:create_web_app()"
+#
+# Only one process opens /dev/hidraw* and the DHT22 pin, so any number of
+# WSGI workers can serve the pages. Sampling, averaging, batched writes and
+# retention are monitor_app's; after every sample the latest raw values,
+# averages and last-hour statistics go to shared_state.py.
+
+import signal
+import sys
+import threading
+
+import monitor_app
+import sensors
+import shared_state
+
+
+def serve_metrics(port):
+    # /metrics of this process, whose counters (frames, DHT22 reads, inserts)
+    # the web workers don't see
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    import metrics
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', metrics.CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Sample the sensors and publish the latest values')
+    parser.add_argument('--sensors', nargs='+', metavar='SENSOR',
+                        help=f"sensors to sample, from: {', '.join(sensors.BACKENDS)} "
+                             f"(default: {' '.join(sensors.DEFAULT_SENSORS)})")
+    parser.add_argument('--retention-days', type=float, metavar='DAYS',
+                        help=f'archive raw rows older than this, 0 to keep them '
+                             f'(default: {monitor_app.RETENTION_DAYS})')
+    parser.add_argument('--state', default=shared_state.DEFAULT_PATH,
+                        help='shared state file, MONITOR_STATE_PATH of the web workers '
+                             f'(default: {shared_state.DEFAULT_PATH})')
+    parser.add_argument('--metrics-port', type=int, help='serve /metrics of this process on this port')
+    args = parser.parse_args()
+
+    monitor_app.configure(args.sensors, args.retention_days)
+    monitor_app.shared_state = shared_state.SharedState(args.state, writable=True)
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
+    # Let SIGTERM (systemd, docker) run the atexit handlers, which flush the
+    # queued rows
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    monitor_app.start_background(warm_plots=False)
+    print(f"Sampling {', '.join(sensor.name for sensor in monitor_app.enabled_sensors)}, "
+          f"publishing to {args.state}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# Live readings for browsers via Server-Sent Events.
+#
+# The sensor side publishes each reading once; every connected client has a
+# small queue of its own that publish() fills without blocking. A client
+# that stops reading just loses its oldest events, it never slows down the
+# reader thread or the other clients.
+
+import json
+import queue
+import threading
+import time
+
+# Seconds between keep-alive comments, so proxies don't close idle streams
+KEEPALIVE_SECONDS = 15
+
+
+class Broadcaster:
+
+    def __init__(self, client_queue_size=64):
+        self.client_queue_size = client_queue_size
+        self._clients = set()
+        self._lock = threading.Lock()
+        # Last event per (device, metric), sent to new clients right away
+        self._latest = {}
+
+    def subscribe(self):
+        client = queue.Queue(maxsize=self.client_queue_size)
+        with self._lock:
+            self._clients.add(client)
+            for event in self._latest.values():
+                client.put_nowait(event)
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def client_count(self):
+        return len(self._clients)
+
+    def publish(self, metric, value, timestamp=None, device=None):
+        reading = {'metric': metric, 'value': round(value, 2),
+                   'time': time.time() if timestamp is None else timestamp}
+        if device is not None:
+            reading['device'] = device
+        event = json.dumps(reading)
+        with self._lock:
+            self._latest[device, metric] = event
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.put_nowait(event)
+            except queue.Full:
+                # Slow client: drop its oldest event to make room
+                try:
+                    client.get_nowait()
+                    client.put_nowait(event)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def stream(self):
+        # Generator of text/event-stream chunks for one client
+        client = self.subscribe()
+        try:
+            # Tell the browser how long to wait before reconnecting
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = client.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f'event: reading\ndata: {event}\n\n'
+        finally:
+            self.unsubscribe(client)
+
+
+def sse_response(broadcaster):
+    from flask import Response
+
+    return Response(broadcaster.stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,206 @@
+# Counters, gauges and histograms in the Prometheus text format (/metrics).
+#
+# Modules create their metrics once at import time and update them on the
+# hot paths; an update is one addition under a per-series lock, cheap
+# enough to leave on a Pi Zero permanently. Labels are best resolved with
+# .labels(...) once, outside the hot path:
+#
+#   FRAMES = metrics.Counter('co2_frames_total', 'Frames read from the monitors')
+#   FRAMES.inc()
+#   RENDER = metrics.Histogram('plot_render_seconds', 'Plot rendering', ['metric'])
+#   RENDER.labels('co2').observe(seconds)
+
+import threading
+import time
+from bisect import bisect_left
+
+# Seconds; from SQLite lookups to slow DHT22 reads
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Seconds; for per-frame work that takes microseconds
+FAST_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005,
+                0.0001, 0.00025, 0.0005, 0.001)
+
+# name -> metric, in the order they were created
+REGISTRY = {}
+_registry_lock = threading.Lock()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _label_text(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            if name in REGISTRY:
+                raise ValueError(f"Metric {name!r} already exists")
+            REGISTRY[name] = self
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} has labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in list(self._children.items()):
+            lines += self._render_child(values, child)
+        return lines
+
+
+class _Value:
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def _render_child(self, values, child):
+        return [f'{self.name}{_label_text(self.labelnames, values)} {_format(child.value)}']
+
+
+class Gauge(_Metric):
+    # A value that goes up and down; with `function` it is read at scrape time
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.function = function
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def _render_child(self, values, child):
+        value = self.function() if self.function is not None else child.value
+        return [f'{self.name}{_label_text(self.labelnames, values)} {_format(value)}']
+
+
+class _HistogramValue:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    # with histogram.time(): ... observes the seconds spent in the block
+
+    def __init__(self, target):
+        self.target = target
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.target.observe(time.perf_counter() - self.start)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return _Timer(self._default)
+
+    def _render_child(self, values, child):
+        with child._lock:
+            counts, total = list(child.counts), child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = f'le="{_format(bound)}"' if bound != float('inf') else 'le="+Inf"'
+            lines.append(f'{self.name}_bucket{_label_text(self.labelnames, values, le)} {cumulative}')
+        labels = _label_text(self.labelnames, values)
+        lines.append(f'{self.name}_sum{labels} {_format(total)}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+PROCESS_START = Gauge('process_start_time_seconds', 'Start time of the process since the epoch')
+PROCESS_START.set(time.time())
+
+
+def render():
+    # Every registered metric in the text exposition format
+    lines = []
+    for metric in list(REGISTRY.values()):
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_response():
+    from flask import Response
+
+    return Response(render(), content_type=CONTENT_TYPE)
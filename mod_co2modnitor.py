@@ -1,32 +1,25 @@
 #!/usr/bin/python3 -u
 
 import sys, fcntl, time
+import errno
+import os
+import select
+import selectors
+import threading
+
+from co2_decoder import FrameDecoder
+import metrics
+
+# One decoder per key: building one computes its tables
+_decoders = {}
 
 def decrypt(key,  data):
-	cstate = [0x48,  0x74,  0x65,  0x6D,  0x70,  0x39,  0x39,  0x65]
-	shuffle = [2, 4, 0, 7, 1, 6, 5, 3]
-	
-	phase1 = [0] * 8
-	for i, o in enumerate(shuffle):
-		phase1[o] = data[i]
-	
-	phase2 = [0] * 8
-	for i in range(8):
-		phase2[i] = phase1[i] ^ key[i]
-	
-	phase3 = [0] * 8
-	for i in range(8):
-		phase3[i] = ( (phase2[i] >> 3) | (phase2[ (i-1+8)%8 ] << 5) ) & 0xff
-	
-	ctmp = [0] * 8
-	for i in range(8):
-		ctmp[i] = ( (cstate[i] >> 4) | (cstate[i]<<4) ) & 0xff
-	
-	out = [0] * 8
-	for i in range(8):
-		out[i] = (0x100 + phase3[i] - ctmp[i]) & 0xff
-	
-	return out
+	# Kept for compatibility; the table-driven decoder does the work
+	key = tuple(key)
+	decoder = _decoders.get(key)
+	if decoder is None:
+		decoder = _decoders[key] = FrameDecoder(key)
+	return list(decoder.decrypt(data))
 
 def hd(d):
 	return " ".join("%02X" % e for e in d)
@@ -38,44 +31,462 @@ def get_co2(values):
     return None
 
 
-def get_all(device):
-    key = [0xc4, 0xc6, 0xc0, 0x92, 0x40, 0x23, 0xdc, 0x96]
-    HIDIOCSFEATURE_9 = 0xC0094806
-    set_report = bytearray([0x00] + key)
+KEY = [0xc4, 0xc6, 0xc0, 0x92, 0x40, 0x23, 0xdc, 0x96]
+HIDIOCSFEATURE_9 = 0xC0094806
 
-    with open(device, "a+b", 0) as fp:
-        fcntl.ioctl(fp, HIDIOCSFEATURE_9, set_report)
+# USB ids of the Holtek based monitors (TFA Dostmann AirCO2ntrol and relabels)
+VENDOR_ID = 0x04d9
+PRODUCT_ID = 0xa052
+SYSFS_HIDRAW = '/sys/class/hidraw'
+# Used when discovery finds nothing, e.g. without sysfs
+DEFAULT_DEVICE = '/dev/hidraw0'
 
-        co2 = None
-        temperature = None
-        while co2 is None or temperature is None:
-            data = list(fp.read(8))
-            decrypted = None
+# Bytes asked for per read(). hidraw returns one 8 byte report per call
+# anyway; replayed devices (pty, FIFO, file) hand over everything buffered.
+READ_SIZE = 8 * 32
+
+FRAMES = metrics.Counter('co2_frames_total', 'Frames read from the CO2 monitors')
+CHECKSUM_ERRORS = metrics.Counter('co2_checksum_errors_total', 'Frames that failed the checksum after decoding')
+DECODE_SECONDS = metrics.Histogram('co2_decode_seconds', 'Time to decode one frame',
+                                   buckets=metrics.FAST_BUCKETS)
+DEVICE_CLOSES = metrics.Counter('co2_device_closes_total', 'Monitors closed by CO2Reader (errors, silence, unplugging)')
+READS = metrics.Counter('co2_reads_total', 'read() calls on the monitors that returned data')
+RESYNCS = metrics.Counter('co2_resyncs_total', 'Times the frame boundary was found again after misaligned bytes')
+
+# Result status of a deadline-bounded read
+STATUS_OK = 'ok'            # both CO2 and temperature were received
+STATUS_PARTIAL = 'partial'  # only one of them arrived before the deadline
+STATUS_TIMEOUT = 'timeout'  # nothing usable arrived before the deadline
+
+
+def _uevent(name, sysfs=SYSFS_HIDRAW):
+    # KEY=value pairs of /sys/class/hidraw/<name>/device/uevent
+    try:
+        with open(os.path.join(sysfs, name, 'device', 'uevent')) as f:
+            return dict(line.rstrip('\n').split('=', 1) for line in f if '=' in line)
+    except OSError:
+        return {}
+
+
+def find_devices(vendor_id=VENDOR_ID, product_id=PRODUCT_ID, sysfs=SYSFS_HIDRAW):
+    # /dev/hidraw* nodes of every attached CO2 monitor, hidraw0 first
+    try:
+        names = os.listdir(sysfs)
+    except OSError:
+        return []
+    devices = []
+    for name in sorted(names, key=lambda name: (len(name), name)):
+        # HID_ID is bus:vendor:product in hex, e.g. 0003:000004D9:0000A052
+        parts = _uevent(name, sysfs).get('HID_ID', '').split(':')
+        if len(parts) == 3 and int(parts[1], 16) == vendor_id and int(parts[2], 16) == product_id:
+            devices.append(os.path.join('/dev', name))
+    return devices
+
+
+def default_device():
+    devices = find_devices()
+    return devices[0] if devices else DEFAULT_DEVICE
+
+
+def device_id(device, sysfs=SYSFS_HIDRAW):
+    # Short stable name of a monitor: the USB port it is plugged into, e.g.
+    # 'usb-1.2' from HID_PHYS=usb-3f980000.usb-1.2/input0. hidraw numbers
+    # depend on plug order, the port does not. Falls back to 'hidraw0'.
+    name = os.path.basename(device)
+    phys = _uevent(name, sysfs).get('HID_PHYS', '')
+    port = phys.split('/')[0].rsplit('-', 1)
+    if phys.startswith('usb-') and len(port) == 2:
+        return 'usb-' + port[1]
+    return name
+
+
+def open_device(device, key=KEY):
+    # Non-blocking fd so reads can be driven by poll() or an event loop
+    fd = os.open(device, os.O_RDWR | os.O_NONBLOCK | os.O_NOCTTY)
+    try:
+        fcntl.ioctl(fd, HIDIOCSFEATURE_9, bytearray([0x00] + list(key)))
+    except OSError as error:
+        # Replayed frames (replay.py) come from a pty, FIFO or file, which
+        # need no key
+        if error.errno not in (errno.ENOTTY, errno.EINVAL):
+            os.close(fd)
+            raise
+    return fd
+
+
+def decode_into(decoder, data, values):
+    # Decode one frame and store its value by opcode; returns the opcode or None
+    start = time.perf_counter()
+    decrypted = decoder.decode(data)
+    DECODE_SECONDS.observe(time.perf_counter() - start)
+    FRAMES.inc()
+    if decrypted is None:
+        # Counted instead of printed; see /metrics
+        CHECKSUM_ERRORS.inc()
+        return None
+    op = decrypted[0]
+    values[op] = decrypted[1] << 8 | decrypted[2]
+    return op
+
+
+class FrameStream:
+    # Splits what is read from a monitor into 8 byte frames. If the frame at
+    # the start of the buffer fails the checksum, the next 7 offsets are
+    # tried for a frame that passes (0x0d terminator and checksum, after
+    # decrypting if needed); without one the 8 bytes are dropped. So after
+    # corrupt or misaligned bytes the stream is back in step within 15 bytes.
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.buffer = bytearray()
+        # The frame at the start of the buffer was already found invalid
+        self._bad_head = False
+
+    def reset(self):
+        self.buffer.clear()
+        self._bad_head = False
+
+    def feed(self, data, values):
+        # Decodes every complete frame of data into `values`; returns the
+        # (op, value) of each valid one, in order
+        buffer = self.buffer
+        buffer += data
+        decoded = []
+        while len(buffer) >= 8:
+            if not self._bad_head:
+                op = decode_into(self.decoder, bytes(buffer[:8]), values)
+                if op is not None:
+                    decoded.append((op, values[op]))
+                    del buffer[:8]
+                    continue
+                self._bad_head = True
+            offset = self._next_frame()
+            if offset is None:
+                # Wait for more bytes to look at
+                break
+            if offset < 8:
+                RESYNCS.inc()
+            del buffer[:offset]
+            self._bad_head = False
+        return decoded
+
+    def _next_frame(self):
+        # Offset of the first valid frame after the start of the buffer, 8 if
+        # none starts in the first frame, None if more bytes are needed
+        for offset in range(1, 8):
+            if offset + 8 > len(self.buffer):
+                return None
+            if self.decoder.decode(bytes(self.buffer[offset:offset + 8])) is not None:
+                return offset
+        return 8
+
+
+def to_reading(values):
+    # Turn raw opcode values into the dict returned by get_all()
+    co2 = values.get(0x50)
+    temperature = values.get(0x42)
+    data = {'CO2': co2,
+            'Temperature': temperature / 16.0 - 273.15 if temperature is not None else None}
+    # Only some models report humidity (0x41 or 0x44)
+    humidity = values.get(0x41, values.get(0x44))
+    if humidity is not None:
+        data['Humidity'] = humidity / 100.0
+    return data
+
+
+def frame_reading(op, value):
+    # (metric, value) for the opcodes we know, otherwise None
+    if op == 0x50:
+        return 'co2', value
+    if op == 0x42:
+        return 'temperature', value / 16.0 - 273.15
+    if op in (0x41, 0x44):
+        return 'humidity', value / 100.0
+    return None
+
+
+def _status(values):
+    if 0x50 in values and 0x42 in values:
+        return STATUS_OK
+    if 0x50 in values or 0x42 in values:
+        return STATUS_PARTIAL
+    return STATUS_TIMEOUT
 
-            if data[4] == 0x0d and (sum(data[:3]) & 0xff) == data[3]:
-                decrypted = data
-            else:
-                decrypted = decrypt(key, data)
 
-            if decrypted[4] != 0x0d or (sum(decrypted[:3]) & 0xff) != decrypted[3]:
-                print("Checksum error")
+def read_all(device=None, timeout=10.0):
+    # Read until both CO2 and temperature are seen or `timeout` seconds pass.
+    # Returns (data, status); missing values are None. timeout=None waits forever.
+    # device=None reads the first monitor find_devices() reports.
+    if device is None:
+        device = default_device()
+    stream = FrameStream(FrameDecoder(KEY))
+    values = {}
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    fd = open_device(device)
+    try:
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        while _status(values) != STATUS_OK:
+            if deadline is None:
+                events = poller.poll()
             else:
-                op = decrypted[0]
-                val = decrypted[1] << 8 | decrypted[2]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                events = poller.poll(remaining * 1000)
+            if not events:
+                break
+            try:
+                data = os.read(fd, READ_SIZE)
+            except BlockingIOError:
+                continue
+            if not data:
+                break
+            READS.inc()
+            stream.feed(data, values)
+    finally:
+        os.close(fd)
+    return to_reading(values), _status(values)
 
-                if op == 0x50:  # CO2 Value
-                    co2 = val
-                elif op == 0x42:  # Temperature Value
-                    temperature = val / 16.0 - 273.15
-                if co2 is None or temperature is None:
-                    time.sleep(0.1)  # Sleep for 100 milliseconds
-        return {'CO2': co2, 'Temperature': temperature}
 
+async def read_all_async(device=None, timeout=10.0):
+    # Same as read_all(), driven by the running event loop instead of a thread
+    import asyncio
 
-if __name__ == "__main__":
-    device = '/dev/hidraw0'  # Default device
-    if len(sys.argv) > 1:
-        device = sys.argv[1]
+    if device is None:
+        device = default_device()
+    loop = asyncio.get_running_loop()
+    stream = FrameStream(FrameDecoder(KEY))
+    values = {}
+    done = loop.create_future()
+
+    fd = open_device(device)
+
+    def on_readable():
+        try:
+            data = os.read(fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as error:
+            if not done.done():
+                done.set_exception(error)
+            return
+        if data:
+            READS.inc()
+            stream.feed(data, values)
+        if not data or _status(values) == STATUS_OK:
+            if not done.done():
+                done.set_result(None)
+
+    loop.add_reader(fd, on_readable)
+    try:
+        await asyncio.wait_for(done, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        loop.remove_reader(fd)
+        os.close(fd)
+    return to_reading(values), _status(values)
+
+
+def get_all(device=None, timeout=10.0):
+    # Kept for existing callers; see read_all() for the status of partial
+    # results. Values that did not arrive within `timeout` seconds are None.
+    data, _ = read_all(device, timeout)
+    return data
+
+
+class _Device:
+    # State of one monitor inside CO2Reader
+
+    def __init__(self, path):
+        self.path = path
+        self.id = device_id(path)
+        self.fd = None
+        # Regular files (replay.py serve --file) cannot be registered with
+        # the selector and are read on every pass instead
+        self.polled = False
+        self.stream = FrameStream(FrameDecoder(KEY))
+        self.values = {}
+        self.last_frame = None
+        self.retry_at = 0.0
+
+
+class CO2Reader:
+    # Keeps the monitors open in a background thread and decodes every frame
+    # as it arrives, so callers can read the latest values from memory
+    # instead of reopening a device and waiting for a full cycle.
+    #
+    # `device` is a device node, a list of them, or None for every monitor
+    # find_devices() reports (re-scanned every `rescan_interval` seconds to
+    # pick up monitors plugged in later). A single thread serves all devices
+    # through a selector, however many there are.
+
+    def __init__(self, device=None, reopen_delay=5.0, stale_timeout=60.0, rescan_interval=30.0):
+        self.discover = device is None
+        paths = [] if device is None else [device] if isinstance(device, str) else list(device)
+        self.reopen_delay = reopen_delay
+        # Reopen a device if no valid frame arrived for this many seconds
+        self.stale_timeout = stale_timeout
+        self.rescan_interval = rescan_interval
+        self.last_update = None
+        self._devices = {path: _Device(path) for path in paths}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._listeners = []
+
+    def add_listener(self, callback):
+        # callback(device_id, op, value) is called from the reader thread for
+        # every valid frame, so it has to be quick and must not block
+        self._listeners.append(callback)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='co2-reader', daemon=True)
+            self._thread.start()
+        return self
 
-    result = get_all(device)
-    print(result)
+    def stop(self):
+        self._stop.set()
+
+    def wait(self, timeout=None):
+        # Block until one device has reported both CO2 and temperature
+        return self._ready.wait(timeout)
+
+    def device_ids(self):
+        with self._lock:
+            return [device.id for device in self._devices.values()]
+
+    def get_all(self, device_id=None):
+        # Same shape as get_all(device), or None before the first full
+        # reading. Without device_id, the first device is used.
+        with self._lock:
+            for device in self._devices.values():
+                if device_id is None or device.id == device_id:
+                    if _status(device.values) != STATUS_OK:
+                        return None
+                    return to_reading(device.values)
+        return None
+
+    def get_all_devices(self):
+        # {device_id: reading} of every device with a full reading
+        with self._lock:
+            return {device.id: to_reading(device.values) for device in self._devices.values()
+                    if _status(device.values) == STATUS_OK}
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        next_scan = 0.0
+        try:
+            while not self._stop.is_set():
+                now = time.monotonic()
+                if self.discover and now >= next_scan:
+                    self._rescan(selector)
+                    next_scan = now + self.rescan_interval
+                for device in list(self._devices.values()):
+                    if device.fd is None:
+                        if now >= device.retry_at:
+                            self._open(selector, device)
+                    elif now - device.last_frame > self.stale_timeout:
+                        print(f"No data from {device.path} for {self.stale_timeout:.0f} s, reopening")
+                        self._close(selector, device)
+                    elif device.polled:
+                        while device.fd is not None and self._read(selector, device):
+                            pass
+
+                # Wake up regularly so stop(), stale devices and reopens are noticed
+                if not selector.get_map():
+                    self._stop.wait(1.0)
+                    continue
+                for key, _ in selector.select(timeout=1.0):
+                    self._read(selector, key.data)
+        finally:
+            for device in list(self._devices.values()):
+                if device.fd is not None:
+                    self._close(selector, device)
+            selector.close()
+
+    def _rescan(self, selector):
+        found = find_devices()
+        with self._lock:
+            for path in list(self._devices):
+                if path not in found:
+                    device = self._devices.pop(path)
+                    if device.fd is not None:
+                        self._close(selector, device)
+            for path in found:
+                if path not in self._devices:
+                    self._devices[path] = _Device(path)
+
+    def _open(self, selector, device):
+        try:
+            device.fd = open_device(device.path)
+        except OSError as error:
+            print(f"Error opening {device.path}:", error)
+            device.retry_at = time.monotonic() + self.reopen_delay
+            return
+        device.last_frame = time.monotonic()
+        # Bytes left from before the reopen belong to no frame of the new fd
+        device.stream.reset()
+        device.polled = False
+        try:
+            selector.register(device.fd, selectors.EVENT_READ, device)
+        except PermissionError:
+            # epoll refuses regular files; they are always readable
+            device.polled = True
+        except (OSError, ValueError) as error:
+            print(f"Error watching {device.path}:", error)
+            os.close(device.fd)
+            device.fd = None
+            device.retry_at = time.monotonic() + self.reopen_delay
+
+    def _close(self, selector, device):
+        # Device went away or went quiet; try again after a short pause
+        DEVICE_CLOSES.inc()
+        if not device.polled:
+            selector.unregister(device.fd)
+        os.close(device.fd)
+        device.fd = None
+        device.retry_at = time.monotonic() + self.reopen_delay
+
+    def _read(self, selector, device):
+        # Returns whether any bytes were read
+        try:
+            data = os.read(device.fd, READ_SIZE)
+        except BlockingIOError:
+            return False
+        except OSError as error:
+            print(f"Error reading from {device.path}:", error)
+            self._close(selector, device)
+            return False
+        if not data:
+            # The end of a regular file, which may still grow
+            if not device.polled:
+                self._close(selector, device)
+            return False
+        READS.inc()
+
+        with self._lock:
+            decoded = device.stream.feed(data, device.values)
+            if not decoded:
+                return True
+            device.last_frame = self.last_update = time.monotonic()
+            if _status(device.values) == STATUS_OK:
+                self._ready.set()
+
+        for op, value in decoded:
+            for listener in self._listeners:
+                listener(device.id, op, value)
+        return True
+
+
+if __name__ == "__main__":
+    # Reads the given device, or every monitor that is plugged in
+    devices = sys.argv[1:] or find_devices() or [DEFAULT_DEVICE]
+    for device in devices:
+        result, status = read_all(device)
+        print(device_id(device), result, status)
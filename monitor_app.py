@@ -0,0 +1,474 @@
+import startup  # first, so its clock starts as early as possible
+from flask import Flask, jsonify, render_template, url_for
+import atexit
+import os
+import threading
+import aggregation
+import storage
+import time
+import live
+import metrics
+import plotting
+import ring_buffer
+import sensors
+import series_api
+
+# The monitor web app. Which sensors are sampled is configuration, see
+# sensors.py; app_plot.py, app_plot_no_humidity.py and
+# app_plot_incl_humidity.py are this app with a fixed set of sensors.
+#
+# Importing this module has no side effects: sensors, the database and the
+# scheduler are only touched once create_app() runs. Use
+#   python3 monitor_app.py --sensors co2 dht22
+# or a WSGI server with the factory, e.g. "monitor_app:create_app()", where
+# MONITOR_SENSORS="co2 dht22" selects the sensors.
+#
+# With several WSGI workers, run the sensors in one process instead,
+#   python3 ingest.py --sensors co2 dht22
+# and serve "monitor_app:create_web_app()": the workers then only read the
+# latest values ingest.py publishes through shared_state.py.
+
+# Minutes between two rows written to the database
+WRITE_INTERVAL_MINUTES = 5
+
+# Rows are queued and written in one transaction once this many are waiting
+# or the oldest is this many seconds old, see storage.BatchWriter
+BATCH_MAX_ROWS = 100
+BATCH_MAX_DELAY = 60.0
+
+# Raw rows older than this many days are moved to monthly archive files
+# every night, see retention.py; 0 keeps everything. MONITOR_RETENTION_DAYS
+# overrides it.
+RETENTION_DAYS = 90
+retention_days = RETENTION_DAYS
+
+# Enabled sensors.Sensor instances, set by create_app()
+enabled_sensors = []
+
+# Every raw reading is pushed to browsers connected to /stream
+live_readings = live.Broadcaster()
+
+# Raw readings of the last 24 h in memory, for "last hour" views and statistics.
+# Keyed by (device_id, metric), and by metric for the values of the index page.
+recent_readings = ring_buffer.RecentReadings()
+
+# Moving averages and 1 min / 5 min / 1 h statistics of every reading,
+# keyed by (device_id, metric). The rows written every 5 minutes hold the
+# 5 minute moving averages.
+aggregates = aggregation.Aggregator()
+WRITE_TIME_CONSTANT = 300
+
+# Last raw value per device_id and metric
+latest_values = {}
+
+# shared_state.SharedState: written after every sample by ingest.py, read
+# by the workers of create_web_app(); None when sensors run in-process
+shared_state = None
+_publish_lock = threading.Lock()
+# Last document read from shared_state by a web worker
+shared_snapshot = None
+
+JOB_SECONDS = metrics.Histogram('scheduler_job_seconds', 'Run time of scheduled jobs', ['job'])
+JOB_LAG_SECONDS = metrics.Histogram('scheduler_job_lag_seconds',
+                                    'Delay from the scheduled time until a job was submitted', ['job'])
+JOB_ERRORS = metrics.Counter('scheduler_job_errors_total', 'Scheduled jobs that raised', ['job'])
+JOB_MISSED = metrics.Counter('scheduler_jobs_missed_total', 'Scheduled runs skipped as too late', ['job'])
+# Time spent in each sensor's sample(), apart from the app's own work
+SAMPLE_SECONDS = metrics.Histogram('sensor_sample_seconds', 'Sensor.sample() calls', ['sensor'])
+metrics.Gauge('sse_clients', 'Browsers connected to /stream', function=live_readings.client_count)
+
+
+def enabled_metrics():
+    # Metrics of the enabled sensors, in storage.METRICS order
+    metrics = {metric for sensor in enabled_sensors for metric in sensor.metrics}
+    return tuple(metric for metric in storage.METRICS if metric in metrics)
+
+
+def web_worker():
+    # True in create_web_app() workers, which must not touch the sensors
+    return shared_state is not None and not shared_state.writable
+
+
+def primary_device():
+    # The monitor shown on the index page; sensors without devices of their
+    # own (the DHT22) add their metrics to it
+    if web_worker():
+        return shared_snapshot['primary_device'] if shared_snapshot is not None else storage.LEGACY_DEVICE
+    for sensor in enabled_sensors:
+        devices = sensor.device_ids()
+        if devices:
+            return devices[0]
+    return storage.LEGACY_DEVICE
+
+
+def get_latest_record():
+    return storage.latest_measurement(primary_device())
+
+
+def seed_averages(device):
+    # Moving averages of a device start from its latest record, which fades
+    # out with its age
+    last_record = storage.latest_measurement(device)
+    if last_record is None:
+        return
+    for metric, value in zip(('temperature', 'co2', 'humidity'), last_record[1:]):
+        if value is not None and metric in enabled_metrics():
+            aggregates.seed((device, metric), value, last_record[0])
+
+
+def current_averages(device):
+    # Moving averages to write for `device`; metrics no enabled sensor
+    # reports stay None and are written as NULL
+    metrics = enabled_metrics()
+    return {metric: aggregates.ema((device, metric), WRITE_TIME_CONSTANT) if metric in metrics else None
+            for metric in storage.METRICS}
+
+
+def devices_with_readings(since=None):
+    # Devices with a reading, or with one at or after `since`
+    return list(dict.fromkeys(device for device, _ in aggregates.keys(since)))
+
+
+def publish_reading(device, metric, value):
+    # Called by streaming sensors for every reading, and for every sample of the others
+    aggregates.add((device, metric), value)
+    live_readings.publish(metric, value, device=device)
+    recent_readings.append((device, metric), value)
+    if device == primary_device():
+        recent_readings.append(metric, value)
+
+
+def sample_sensor(sensor):
+    # Scheduled every sensor.interval seconds for each enabled sensor
+    with SAMPLE_SECONDS.labels(sensor.name).time():
+        samples = sensor.sample()
+    primary = primary_device()
+    for device, values in samples.items():
+        device = primary if device is None else device
+        for metric, value in values.items():
+            if value is None:
+                continue
+            # Store last raw measurement; streaming sensors have already fed
+            # every reading to the moving averages
+            latest_values.setdefault(device, {})[metric] = value
+            if not sensor.streams:
+                publish_reading(device, metric, value)
+    if shared_state is not None:
+        publish_state()
+
+
+def hour_stats():
+    # Statistics of the last hour of the primary device
+    primary = primary_device()
+    stats = {}
+    for metric in enabled_metrics():
+        values = aggregates.window((primary, metric), 3600)
+        if values is not None:
+            stats[metric] = {key: round(value, 2) for key, value in values.items()}
+    return stats
+
+
+def aggregate_stats():
+    # {device_id: {metric: aggregates.snapshot()}}, as served by /api/stats
+    if web_worker():
+        return shared_snapshot['aggregates'] if shared_snapshot is not None else {}
+    stats = {}
+    for device, metric in aggregates.keys():
+        stats.setdefault(device, {})[metric] = aggregates.snapshot((device, metric))
+    return stats
+
+
+def publish_state():
+    # Latest values for the web workers, see create_web_app()
+    with _publish_lock:
+        shared_state.publish({
+            'time': time.time(),
+            'primary_device': primary_device(),
+            # Copies; other sample jobs may be adding devices meanwhile
+            'latest': {device: dict(values) for device, values in list(latest_values.items())},
+            'averages': {device: current_averages(device) for device in devices_with_readings()},
+            'hour_stats': hour_stats(),
+            'aggregates': aggregate_stats(),
+        })
+
+
+def follow_shared_state(source, interval=1.0):
+    # Runs in every web worker: takes over what ingest.py published to
+    # `source` and passes changed values on to /stream and the ring buffer.
+    # Ends when another app replaces the shared state.
+    global shared_snapshot
+    seen = 0
+    while shared_state is source:
+        version, state = source.read()
+        if state is not None and version != seen:
+            seen = version
+            shared_snapshot = state
+            for device, values in state['latest'].items():
+                previous = latest_values.get(device, {})
+                for metric, value in values.items():
+                    if previous.get(metric) != value:
+                        publish_reading(device, metric, value)
+                latest_values[device] = values
+        time.sleep(interval)
+
+
+def write_sensor_data():
+    # Note: This correctly writes the AVERAGES to the DB, one row per monitor.
+    # The rows are queued; writer flushes them in batches.
+    # Only devices heard from within the last write interval (or sample
+    # interval, if longer): an unplugged monitor would otherwise get its
+    # frozen averages written, and averaged into the combined series, forever
+    timestamp = time.time()
+    period = max([WRITE_INTERVAL_MINUTES * 60] + [sensor.interval for sensor in enabled_sensors])
+    for device in devices_with_readings(since=timestamp - period):
+        values = current_averages(device)
+        writer.add(values['temperature'], values['co2'], values['humidity'], timestamp=timestamp, device=device)
+
+
+def on_flush(rows):
+    # Render the default plots now rather than on the next page view
+    plotting.warm_cache(enabled_metrics())
+
+
+scheduler = None
+writer = None
+
+
+def timed_job(job_id, func):
+    # func wrapped to record its run time under `job_id`
+    histogram = JOB_SECONDS.labels(job_id)
+
+    def job(*args):
+        with histogram.time():
+            return func(*args)
+    return job
+
+
+def on_job_event(event):
+    from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+
+    if event.code == EVENT_JOB_SUBMITTED:
+        lag = time.time() - event.scheduled_run_times[-1].timestamp()
+        JOB_LAG_SECONDS.labels(event.job_id).observe(max(lag, 0.0))
+    elif event.code == EVENT_JOB_ERROR:
+        JOB_ERRORS.labels(event.job_id).inc()
+    elif event.code == EVENT_JOB_MISSED:
+        JOB_MISSED.labels(event.job_id).inc()
+
+
+def archive_old_rows():
+    # Scheduled every night
+    import retention
+
+    moved = retention.archive(retention_days)
+    if moved:
+        plotting.plot_cache.clear()
+
+
+def first_sample():
+    # Give the sensors a moment to deliver a first reading (the CO2 monitor
+    # needs a full cycle), then sample and write the first data. Runs on
+    # the scheduler so serving starts at once.
+    for sensor in enabled_sensors:
+        sensor.wait(timeout=10)
+    for sensor in enabled_sensors:
+        sample_sensor(sensor)
+    write_sensor_data()
+    # The first rows should show up at once
+    writer.flush()
+
+
+def start_background(warm_plots=True):
+    # warm_plots: render the default plots after each write; pointless in
+    # ingest.py, which serves no plots
+    global scheduler, writer
+    # Only needed when actually sampling, so imported here
+    from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    # Before the sensors start: streaming ones feed the averages from
+    # their first frame on, and seeding only fills averages without a value
+    for device in storage.devices():
+        if device != storage.LEGACY_DEVICE:
+            seed_averages(device)
+    for sensor in enabled_sensors:
+        sensor.start(publish_reading if sensor.streams else None)
+        atexit.register(sensor.stop)
+
+    writer = storage.BatchWriter(max_rows=BATCH_MAX_ROWS, max_delay=BATCH_MAX_DELAY,
+                                 on_flush=on_flush if warm_plots else None).start()
+
+    # Every sensor is sampled at its own interval; data is written every 5 minutes
+    scheduler = BackgroundScheduler()
+    scheduler.add_listener(on_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+    scheduler.add_job(func=timed_job('first-sample', first_sample), id='first-sample')
+    for sensor in enabled_sensors:
+        job_id = f'sample-{sensor.name}'
+        scheduler.add_job(func=timed_job(job_id, sample_sensor), args=[sensor], trigger="interval",
+                          seconds=sensor.interval, id=job_id)
+    scheduler.add_job(func=timed_job('write', write_sensor_data), trigger="interval",
+                      minutes=WRITE_INTERVAL_MINUTES, id='write')
+    if retention_days:
+        scheduler.add_job(func=timed_job('retention', archive_old_rows), trigger="cron",
+                          hour=3, minute=30, id='retention')
+    scheduler.start()
+
+    # When exiting the app (in reverse order): shut down the scheduler, write
+    # the queued rows, close the database
+    atexit.register(storage.close_all)
+    atexit.register(writer.close)
+    atexit.register(lambda: scheduler.shutdown())
+
+
+def rounded(value):
+    return round(float(value), 2) if value is not None else 'N/A'
+
+
+def reading_context():
+    metrics = enabled_metrics()
+    primary = primary_device()
+
+    # 1. Fetch the last AVERAGE record from the database; a web worker shows
+    # N/A until ingest.py has told it which monitor is the primary one
+    waiting = web_worker() and shared_snapshot is None
+    last_avg_record = None if waiting else get_latest_record()
+    averages = dict(zip(('temperature', 'co2', 'humidity'), last_avg_record[1:])) if last_avg_record else {}
+
+    # 2. The last RAW values from memory
+    raw = latest_values.get(primary, {})
+
+    context = {}
+    for metric in metrics:
+        # These are the 5-min Averages from DB
+        context[f'last_{metric}'] = rounded(averages.get(metric))
+        # These are the Raw values from memory
+        context[f'raw_{metric}'] = rounded(raw.get(metric))
+
+    # 3. Statistics of the last hour, or ingest.py's
+    if web_worker():
+        stats = shared_snapshot['hour_stats'] if shared_snapshot is not None else {}
+    else:
+        stats = hour_stats()
+
+    # 4. Latest values of every monitor, when there is more than one
+    devices = []
+    if len(latest_values) > 1:
+        for device, values in latest_values.items():
+            devices.append({'id': device,
+                            'temperature': rounded(values.get('temperature')),
+                            'co2': rounded(values.get('co2'))})
+
+    return dict(primary_device=primary, devices=devices, hour_stats=stats, **context)
+
+
+def index():
+    # Pass BOTH sets of data to the template
+    return render_template('index_css.html', plot_metrics=enabled_metrics(), stream_url=url_for('stream'),
+                           **reading_context())
+
+
+def index_client():
+    # Same page, but the charts are drawn by the browser from /api/series
+    plots = [(metric, plotting.PLOTS[metric][0], plotting.PLOTS[metric][1]) for metric in enabled_metrics()]
+    # Monitors with stored data, for the device filter of the charts
+    plot_devices = [device for device in storage.devices() if device != storage.LEGACY_DEVICE]
+    return render_template('index_client.html', plots=plots, plot_devices=plot_devices,
+                           stream_url=url_for('stream'), **reading_context())
+
+
+def stream():
+    # Server-Sent Events with every raw reading as it arrives
+    return live.sse_response(live_readings)
+
+
+def api_series():
+    return series_api.series_response(recent_readings)
+
+
+def api_stats():
+    # Moving averages and 1 min / 5 min / 1 h statistics per device and metric
+    return jsonify(aggregate_stats())
+
+
+def metrics_view():
+    # Prometheus text format, see metrics.py
+    return metrics.metrics_response()
+
+
+def plot_view(metric):
+    def view():
+        return plotting.plot_response(metric)
+    return view
+
+
+def configure(sensor_specs=None, retention=None):
+    # sensor_specs: names or specs as in sensors.py; defaults to the
+    # MONITOR_SENSORS environment variable, then sensors.DEFAULT_SENSORS.
+    # retention: days of raw rows to keep, see RETENTION_DAYS.
+    global retention_days, shared_state, shared_snapshot
+    shared_state = shared_snapshot = None
+    if sensor_specs is None:
+        sensor_specs = os.environ.get('MONITOR_SENSORS', '').split() or sensors.DEFAULT_SENSORS
+    enabled_sensors[:] = [sensors.create(spec) for spec in sensor_specs]
+    if retention is None:
+        retention = float(os.environ.get('MONITOR_RETENTION_DAYS', RETENTION_DAYS))
+    retention_days = retention
+
+
+def create_app(sensor_specs=None, start_sensors=True, retention=None):
+    configure(sensor_specs, retention)
+
+    app = Flask(__name__)
+    app.add_url_rule('/', view_func=index)
+    app.add_url_rule('/client', view_func=index_client)
+    app.add_url_rule('/api/series', view_func=api_series)
+    app.add_url_rule('/api/stats', view_func=api_stats)
+    app.add_url_rule('/stream', view_func=stream)
+    app.add_url_rule('/metrics', view_func=metrics_view)
+    # /plot/<metric> for the metrics of the enabled sensors
+    for metric in enabled_metrics():
+        app.add_url_rule(f'/plot/{metric}', endpoint=f'plot_{metric}', view_func=plot_view(metric))
+    if start_sensors:
+        start_background()
+    startup.mark('app created')
+    return app
+
+
+def create_web_app(sensor_specs=None, state_path=None):
+    # The app without sensors, showing what ingest.py publishes; safe to run
+    # in any number of workers. sensor_specs should match ingest.py's, they
+    # decide which plots are offered. state_path defaults to
+    # MONITOR_STATE_PATH, then shared_state.DEFAULT_PATH.
+    global shared_state
+    import shared_state as shared
+
+    app = create_app(sensor_specs, start_sensors=False)
+    shared_state = shared.SharedState(state_path or os.environ.get('MONITOR_STATE_PATH', shared.DEFAULT_PATH))
+    threading.Thread(target=follow_shared_state, args=(shared_state,), name='shared-state', daemon=True).start()
+    return app
+
+
+def main(sensor_specs=None, module='monitor_app'):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='CO2, temperature and humidity monitor')
+    parser.add_argument('--sensors', nargs='+', default=sensor_specs, metavar='SENSOR',
+                        help=f"sensors to sample, from: {', '.join(sensors.BACKENDS)} "
+                             f"(default: {' '.join(sensors.DEFAULT_SENSORS)})")
+    parser.add_argument('--retention-days', type=float, metavar='DAYS',
+                        help=f'archive raw rows older than this, 0 to keep them (default: {RETENTION_DAYS})')
+    parser.add_argument('--startup-report', action='store_true',
+                        help='print how long importing this app takes per module and exit')
+    args = parser.parse_args()
+
+    if args.startup_report:
+        startup.print_import_report(module)
+        return
+
+    app = create_app(args.sensors, retention=args.retention_days)
+    print(f"Ready to serve after {startup.timings['app created']:.2f} s")
+    app.run(host='0.0.0.0', port=5000, debug=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import datetime
+import io
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, request
+
+import metrics
+import storage
+
+# matplotlib takes seconds to import on a Pi Zero, so it is only imported
+# when the first plot is actually rendered.
+
+# metric -> (title, y axis label)
+PLOTS = {
+    'temperature': ('Temperature', 'Temperature (°C)'),
+    'co2': ('CO2 Levels', 'CO2 (ppm)'),
+    'humidity': ('Humidity', 'Humidity (%)'),
+}
+
+# Ranges /plot/<metric>?hours=N offers. Every other value would be one more
+# render under the cache lock, so any client could keep the Pi busy.
+PLOT_HOURS = (1, 6, 12, 24, 48, 168, 720, 2160, 8760)
+
+RENDER_SECONDS = metrics.Histogram('plot_render_seconds', 'Rendering a PNG plot, query included', ['metric'])
+
+
+def period_label(hours):
+    if hours % 24 == 0 and hours > 48:
+        return f'the last {hours // 24} days'
+    return f'the last {hours} hours'
+
+
+def set_x_ticks(fig, ax, times):
+    # `times` is a datetime64 array in UTC; ticks are labelled in local time
+    import matplotlib.dates as mdates
+    from dateutil import tz
+
+    if len(times) == 0:  # Handle case with no data
+        return
+    time_range = (times.max() - times.min()).item()
+    local = tz.tzlocal()
+
+    if time_range > datetime.timedelta(days=2):
+        # Longer ranges are labelled by date
+        locator = mdates.AutoDateLocator(tz=local, maxticks=8)
+        formatter = mdates.DateFormatter('%d.%m.', tz=local)
+    else:
+        if time_range <= datetime.timedelta(hours=6):
+            interval = 1
+        else:
+            interval_hours = (time_range.total_seconds() // 3600) // 6
+            interval = max(1, int(interval_hours))
+        locator = mdates.HourLocator(interval=interval, tz=local)
+        formatter = mdates.DateFormatter('%H:%M', tz=local)
+
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(formatter)
+    fig.autofmt_xdate()
+
+
+# Default figure is 6.4 inches at 100 dpi; more points than pixels are not visible
+MAX_POINTS = 640
+
+
+def render_plot(metric, hours=24, max_points=MAX_POINTS, device=None):
+    # Returns the PNG of `metric` over the last `hours` hours, of one device
+    # or of all of them
+    with RENDER_SECONDS.labels(metric).time():
+        return _render_plot(metric, hours, max_points, device)
+
+
+def _render_plot(metric, hours, max_points, device):
+    from matplotlib.figure import Figure
+    from downsample import downsample
+
+    title, ylabel = PLOTS[metric]
+    resolution, times, values, lows, highs = storage.query_series_arrays(metric, time.time() - hours * 3600,
+                                                                            device=device)
+    times, values, lows, highs = downsample(times, values, lows, highs, n_out=max_points)
+    # matplotlib plots datetime64 directly, no per-point datetime objects
+    times = times.astype('datetime64[s]')
+
+    fig = Figure()
+    ax = fig.subplots()
+    ax.plot(times, values)
+    if resolution != 'raw':
+        # Rollups also know the range within each bucket
+        ax.fill_between(times, lows, highs, alpha=0.3, linewidth=0)
+    set_x_ticks(fig, ax, times)
+    ax.set_title(f'{title} over {period_label(hours)}' + (f' ({device})' if device else ''))
+    ax.set_xlabel('Time')
+    ax.set_ylabel(ylabel)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight')
+    return buf.getvalue()
+
+
+class PlotCache:
+    # Rendered PNGs keyed by (metric, hours, device), valid as long as no new row has
+    # been written. Rendering is serialized: on a single-core Pi two parallel
+    # renders are no faster, and the second request can reuse the first.
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, metric, hours, version=None, device=None):
+        # Returns (version, png); `version` is storage.last_write()
+        if version is None:
+            version = storage.last_write()
+        key = (metric, hours, device)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                entry = (version, render_plot(metric, hours, device=device))
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+plot_cache = PlotCache()
+
+
+def warm_cache(metrics, hours=24, device=None):
+    # Called right after a write so the next page view finds fresh plots
+    version = storage.last_write()
+    for metric in metrics:
+        plot_cache.get(metric, hours, version, device)
+
+
+def plot_response(metric):
+    # Flask response for /plot/<metric>?hours=N[&device=ID] that answers 304
+    # when the browser already has the current image
+    hours = request.args.get('hours', 24, type=int)
+    if hours not in PLOT_HOURS:
+        return Response(f"hours must be one of {', '.join(map(str, PLOT_HOURS))}", status=400,
+                        mimetype='text/plain')
+    device = request.args.get('device') or None
+    if device is not None and device not in storage.devices():
+        return Response(f"Unknown device {device!r}", status=404, mimetype='text/plain')
+    version = storage.last_write()
+    row_id, written = version
+    etag = f'{metric}-{hours}-{device or "all"}-{row_id}'
+    if request.if_none_match.contains(etag):
+        png = b''
+    else:
+        _, png = plot_cache.get(metric, hours, version, device)
+
+    response = Response(png, mimetype='image/png')
+    response.set_etag(etag)
+    if written is not None:
+        response.last_modified = datetime.datetime.fromtimestamp(written, datetime.timezone.utc)
+    # Let browsers keep the image but always revalidate it
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
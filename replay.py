@@ -0,0 +1,207 @@
+# Record raw monitor frames and play them back as a fake device.
+#
+#   python3 replay.py capture /dev/hidraw0 frames.co2 [--seconds 3600]
+#   python3 replay.py generate frames.co2 [--hours 24]
+#   python3 replay.py serve frames.co2 [--speed 100] [--loop] [--fifo PATH | --file PATH]
+#
+# A recording is a header followed by (time, frame) records holding the
+# 8 bytes exactly as read from the device, i.e. still encrypted. 'generate'
+# makes one up from simulated values. 'serve' replays a recording with its
+# original timing (divided by --speed; 0 means as fast as possible) on a
+# pty by default, or a FIFO, or writes the bare frames into a file. Point
+# get_all(), read_all() or the app (--sensors co2:device=PATH) at the path
+# it prints; open_device() skips the HID key setup for such devices.
+
+import math
+import os
+import random
+import struct
+import sys
+import time
+
+import mod_co2modnitor
+from co2_decoder import FrameDecoder, make_frame
+
+MAGIC = b'CO2F'
+VERSION = 1
+HEADER = struct.Struct('<4sBxxx')
+# Epoch seconds, raw frame
+RECORD = struct.Struct('<d8s')
+
+# The monitor sends a value about every 5 s, in a cycle over its opcodes
+GENERATE_PERIOD = 5.0
+
+
+def write_recording(path, records):
+    # records: iterable of (time, frame); returns the number written
+    count = 0
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION))
+        for timestamp, frame in records:
+            f.write(RECORD.pack(timestamp, bytes(frame)))
+            count += 1
+    return count
+
+
+def read_recording(path):
+    # Yields (time, frame) of a recording
+    with open(path, 'rb') as f:
+        magic, version = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a frame recording")
+        while True:
+            record = f.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            yield RECORD.unpack(record)
+
+
+def capture(device, path, seconds=None):
+    # Records frames from `device` for `seconds` (None: until Ctrl-C)
+    fd = mod_co2modnitor.open_device(device)
+    deadline = None if seconds is None else time.monotonic() + seconds
+
+    def frames():
+        import select
+
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        try:
+            while deadline is None or time.monotonic() < deadline:
+                if not poller.poll(1000):
+                    continue
+                try:
+                    data = os.read(fd, 8)
+                except BlockingIOError:
+                    continue
+                if len(data) < 8:
+                    return
+                yield time.time(), data
+        except KeyboardInterrupt:
+            pass
+
+    try:
+        return write_recording(path, frames())
+    finally:
+        os.close(fd)
+
+
+def generate(path, hours=24.0, start=None, seed=None):
+    # Writes a recording of simulated CO2, temperature and humidity frames,
+    # encrypted like a real monitor's
+    rand = random.Random(seed)
+    encrypt = FrameDecoder().encrypt
+    start = time.time() - hours * 3600 if start is None else start
+    co2 = 600.0
+
+    def records():
+        nonlocal co2
+        t = start
+        while t < start + hours * 3600:
+            day = math.sin(2 * math.pi * (t % 86400) / 86400)
+            co2 = min(max(co2 + rand.gauss(0, 10) + (600 - co2) * 0.02, 400), 5000)
+            temperature = 21 + 2 * day + rand.gauss(0, 0.05)
+            humidity = 45 - 5 * day + rand.gauss(0, 0.2)
+            for op, value in ((0x50, round(co2)),
+                              (0x42, round((temperature + 273.15) * 16)),
+                              (0x44, round(humidity * 100))):
+                yield t, encrypt(make_frame(op, value))
+                t += GENERATE_PERIOD / 3
+
+    return write_recording(path, records())
+
+
+def open_output(fifo=None, file=None):
+    # Returns (fd to write frames to, path to read them from, fds to close)
+    if file is not None:
+        fd = os.open(file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        return fd, file, [fd]
+    if fifo is not None:
+        if not os.path.exists(fifo):
+            os.mkfifo(fifo)
+        # Opened read-write so the FIFO stays usable while readers come and go
+        fd = os.open(fifo, os.O_RDWR)
+        return fd, fifo, [fd]
+    import pty
+    import tty
+
+    master, slave = pty.openpty()
+    # Raw mode, or the terminal would turn the 0x0d in every frame into 0x0a
+    tty.setraw(slave)
+    return master, os.ttyname(slave), [master, slave]
+
+
+def serve(path, speed=1.0, loop=False, fifo=None, file=None, ready=None):
+    # Plays a recording to a pty, FIFO or file; ready(device_path) is called
+    # once the device can be opened. Returns the number of frames written.
+    fd, device, fds = open_output(fifo, file)
+    if file is not None:
+        # A plain file is read at once, timing does not matter
+        speed = 0
+    if ready is not None:
+        ready(device)
+    count = 0
+    try:
+        while True:
+            begin = time.monotonic()
+            first = None
+            for timestamp, frame in read_recording(path):
+                if first is None:
+                    first = timestamp
+                if speed:
+                    delay = begin + (timestamp - first) / speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                os.write(fd, frame)
+                count += 1
+            if not loop or first is None:
+                return count
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Record and replay CO2 monitor frames')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    capture_parser = commands.add_parser('capture', help='record frames from a monitor')
+    capture_parser.add_argument('device')
+    capture_parser.add_argument('output')
+    capture_parser.add_argument('--seconds', type=float, help='stop after this long (default: Ctrl-C)')
+
+    generate_parser = commands.add_parser('generate', help='make up a recording from simulated values')
+    generate_parser.add_argument('output')
+    generate_parser.add_argument('--hours', type=float, default=24.0)
+    generate_parser.add_argument('--seed', type=int)
+
+    serve_parser = commands.add_parser('serve', help='replay a recording as a device')
+    serve_parser.add_argument('recording')
+    serve_parser.add_argument('--speed', type=float, default=1.0,
+                              help='speed-up factor, 0 for as fast as possible (default: 1)')
+    serve_parser.add_argument('--loop', action='store_true', help='start over at the end')
+    output = serve_parser.add_mutually_exclusive_group()
+    output.add_argument('--fifo', help='replay into this FIFO instead of a pty')
+    output.add_argument('--file', help='write the bare frames to this file')
+
+    args = parser.parse_args()
+    if args.command == 'capture':
+        count = capture(args.device, args.output, args.seconds)
+        print(f"Captured {count} frames to {args.output}")
+    elif args.command == 'generate':
+        count = generate(args.output, args.hours, seed=args.seed)
+        print(f"Generated {count} frames to {args.output}")
+    else:
+        def ready(device):
+            print(f"Replaying {args.recording} on {device} at {args.speed:g}x", flush=True)
+        try:
+            count = serve(args.recording, args.speed, args.loop, args.fifo, args.file, ready)
+        except KeyboardInterrupt:
+            return
+        print(f"Replayed {count} frames")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+# Keeps sensor_data.db small: raw rows older than a given age are moved
+# into gzip'd CSV files, one per month, and the freed pages are returned
+# to the file system.
+#
+#   python3 retention.py --days 90 [--archive-dir archive] [--db sensor_data.db]
+#
+# The app runs this daily (see monitor_app.RETENTION_DAYS). The hourly and
+# daily rollups are kept, so plots of old ranges still work; only raw
+# resolution is gone. Rows are appended to archive/measurements-YYYY-MM.csv.gz
+# (UTC months, a multi-member gzip file that zcat and gzip.open read as
+# one) before they are deleted, so a crash in between can leave a row in
+# both places but never in neither.
+
+import calendar
+import csv
+import datetime
+import gzip
+import io
+import os
+import time
+
+import metrics
+import storage
+
+ARCHIVE_DIR = 'archive'
+
+COLUMNS = ('time', 'device_id', 'temperature', 'co2', 'humidity')
+
+ARCHIVED_ROWS = metrics.Counter('retention_archived_rows_total', 'Raw rows moved to archive files')
+RUN_SECONDS = metrics.Histogram('retention_run_seconds', 'Archiving and vacuuming old rows')
+
+
+def archive_path(year, month, archive_dir=ARCHIVE_DIR):
+    return os.path.join(archive_dir, f'measurements-{year:04d}-{month:02d}.csv.gz')
+
+
+def months(start, end):
+    # (year, month, first second, first second of the next month) of the UTC
+    # months from the one containing `start` up to `end` (epoch seconds)
+    day = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+    year, month = day.year, day.month
+    while True:
+        begin = calendar.timegm((year, month, 1, 0, 0, 0))
+        if begin >= end:
+            return
+        year_next, month_next = (year + 1, 1) if month == 12 else (year, month + 1)
+        yield year, month, begin, calendar.timegm((year_next, month_next, 1, 0, 0, 0))
+        year, month = year_next, month_next
+
+
+def enable_incremental_vacuum(conn):
+    # auto_vacuum can only be switched by a full VACUUM, done once per database
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+
+
+def _archive_range(conn, start, end, path):
+    # Appends the rows with start <= time < end to `path`; returns how many
+    rows = conn.execute(f'''
+        SELECT {', '.join(COLUMNS)} FROM measurements
+        WHERE time >= ? AND time < ? ORDER BY time ASC
+    ''', (start, end))
+    first = rows.fetchone()
+    if first is None:
+        return 0
+    new = not os.path.exists(path)
+    count = 0
+    with open(path, 'ab') as f:
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=f, mode='ab'), newline='') as text:
+            writer = csv.writer(text)
+            if new:
+                writer.writerow(COLUMNS)
+            writer.writerow(first)
+            count += 1
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        # On disk, including the gzip trailer, before the rows are deleted
+        f.flush()
+        os.fsync(f.fileno())
+    return count
+
+
+def archive(days, archive_dir=ARCHIVE_DIR, path=storage.DB_PATH, now=None):
+    # Moves raw rows older than `days` days into the monthly archive files and
+    # vacuums the database. Returns the number of rows moved.
+    with RUN_SECONDS.time():
+        cutoff = int((time.time() if now is None else now) - days * 86400)
+        os.makedirs(archive_dir, exist_ok=True)
+        moved = 0
+        with storage.connection(path) as conn:
+            oldest = conn.execute('SELECT min(time) FROM measurements').fetchone()[0]
+        if oldest is not None and oldest < cutoff:
+            for year, month, begin, end in months(oldest, cutoff):
+                end = min(end, cutoff)
+                # One transaction per month: the rows are written out, then deleted
+                with storage.connection(path) as conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    count = _archive_range(conn, begin, end, archive_path(year, month, archive_dir))
+                    conn.execute('DELETE FROM measurements WHERE time >= ? AND time < ?', (begin, end))
+                moved += count
+                ARCHIVED_ROWS.inc(count)
+        with storage.connection(path) as conn:
+            enable_incremental_vacuum(conn)
+            # Frees one page per step, so all rows have to be fetched
+            conn.execute('PRAGMA incremental_vacuum').fetchall()
+            # Also shrink the WAL, which grew by the deleted pages
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return moved
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Archive old raw rows of sensor_data.db and vacuum it')
+    parser.add_argument('--days', type=float, required=True, help='keep raw rows of this many days')
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    parser.add_argument('--db', default=storage.DB_PATH)
+    args = parser.parse_args()
+
+    moved = archive(args.days, args.archive_dir, args.db)
+    storage.close_all()
+    print(f"Archived {moved} rows to {args.archive_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Recent raw samples kept in memory.
+#
+# Each metric has a fixed-capacity ring of (time, value) pairs stored in two
+# preallocated array('d') columns (16 bytes per sample, no per-sample
+# objects). The sampler appends under a lock; readers take a copy of the
+# window they need, so "last hour" views never touch the database.
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+# The monitor reports each value every few seconds; one sample per metric
+# every 2 s over 24 h is 43200 samples, about 0.7 MB per metric.
+DEFAULT_CAPACITY = 24 * 3600 // 2
+
+
+class RingBuffer:
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._times = array('d', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            self._times[self._next] = timestamp
+            self._values[self._next] = value
+            self._next = (self._next + 1) % self.capacity
+            if self._count < self.capacity:
+                self._count += 1
+
+    def snapshot(self, since=None):
+        # Copies of (times, values), oldest first, optionally only from `since`
+        with self._lock:
+            start = (self._next - self._count) % self.capacity
+            if start + self._count <= self.capacity:
+                times = self._times[start:start + self._count]
+                values = self._values[start:start + self._count]
+            else:
+                times = self._times[start:] + self._times[:self._next]
+                values = self._values[start:] + self._values[:self._next]
+        if since is not None:
+            first = bisect_left(times, since)
+            times, values = times[first:], values[first:]
+        return times, values
+
+
+class RecentReadings:
+    # One RingBuffer per metric, created on first use
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def _buffer(self, metric):
+        buffer = self._buffers.get(metric)
+        if buffer is None:
+            with self._lock:
+                buffer = self._buffers.setdefault(metric, RingBuffer(self.capacity))
+        return buffer
+
+    def append(self, metric, value, timestamp=None):
+        self._buffer(metric).append(value, timestamp)
+
+    def snapshot(self, metric, seconds=None):
+        # Empty arrays for keys never appended to; reading must not allocate
+        # a buffer, the keys may come from a request
+        buffer = self._buffers.get(metric)
+        if buffer is None:
+            return array('d'), array('d')
+        since = None if seconds is None else time.time() - seconds
+        return buffer.snapshot(since)
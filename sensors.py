@@ -0,0 +1,167 @@
+# Sensor backends for monitor_app.py.
+#
+# A backend declares the metrics it reports and how often the app samples
+# it; BACKENDS maps the names used on the command line to the classes.
+# Hardware modules are only imported in start(), so a sensor that is not
+# enabled costs no import and no CPU. Adding a sensor means a Sensor
+# subclass and one entry in BACKENDS.
+#
+# Sensors are given as 'name' or 'name:key=value,key=value', e.g.
+#   co2 dht22:pin=D4,interval=120 simulated:interval=5
+
+import math
+import random
+import time
+
+DEFAULT_SENSORS = ('co2', 'dht22')
+
+
+class Sensor:
+    name = None
+    # Metrics of storage.METRICS this sensor reports
+    metrics = ()
+    # Seconds between two samples, unless given as interval=...
+    interval = 60.0
+    # True if the sensor calls on_reading itself as values arrive; otherwise
+    # the app publishes every sample
+    streams = False
+
+    def __init__(self, interval=None):
+        if interval is not None:
+            self.interval = float(interval)
+
+    def start(self, on_reading=None):
+        # Open the hardware. on_reading(device_id, metric, value) may be
+        # called from any thread.
+        pass
+
+    def wait(self, timeout=None):
+        # Block until a first sample is available, at most `timeout` seconds
+        return True
+
+    def stop(self):
+        pass
+
+    def device_ids(self):
+        # Monitors this sensor reports separately, in a stable order
+        return []
+
+    def sample(self):
+        # {device_id: {metric: value}}. device_id None stands for the main
+        # monitor, for sensors that add metrics to it (like the DHT22).
+        raise NotImplementedError
+
+
+class CO2Sensor(Sensor):
+    # TFA/AirCO2ntrol USB monitors; every one plugged in unless `device` is set
+    name = 'co2'
+    metrics = ('temperature', 'co2')
+    streams = True
+
+    def __init__(self, interval=None, device=None):
+        super().__init__(interval)
+        self.device = device
+        self.reader = None
+
+    def start(self, on_reading=None):
+        from mod_co2modnitor import CO2Reader, frame_reading
+
+        self.reader = CO2Reader(self.device)
+        if on_reading is not None:
+            def on_frame(device, op, value):
+                reading = frame_reading(op, value)
+                if reading is not None:
+                    on_reading(device, *reading)
+            self.reader.add_listener(on_frame)
+        self.reader.start()
+
+    def wait(self, timeout=None):
+        return self.reader.wait(timeout)
+
+    def stop(self):
+        self.reader.stop()
+
+    def device_ids(self):
+        # None until start(), e.g. in an app built with start_sensors=False
+        if self.reader is None:
+            return []
+        return self.reader.device_ids()
+
+    def sample(self):
+        samples = {}
+        for device, reading in self.reader.get_all_devices().items():
+            values = {'temperature': reading['Temperature'], 'co2': reading['CO2']}
+            # Only some models measure humidity
+            if 'Humidity' in reading:
+                values['humidity'] = reading['Humidity']
+            samples[device] = values
+        return samples
+
+
+class DHT22Sensor(Sensor):
+    # DHT22 on a GPIO pin; its humidity is stored with the main CO2 monitor
+    name = 'dht22'
+    metrics = ('humidity',)
+
+    def __init__(self, interval=None, pin='D14'):
+        super().__init__(interval)
+        self.pin = pin
+        self.reader = None
+
+    def start(self, on_reading=None):
+        from general_humidity_sensor_dht22 import DHT22Reader
+
+        self.reader = DHT22Reader(self.pin)
+
+    def stop(self):
+        self.reader.close()
+
+    def sample(self):
+        humidity = self.reader.read()['humidity']
+        if humidity is None:
+            return {}
+        return {None: {'humidity': humidity}}
+
+
+class SimulatedSensor(Sensor):
+    # Plausible readings without any hardware, for development and demos
+    name = 'simulated'
+    metrics = ('temperature', 'co2', 'humidity')
+    interval = 10.0
+
+    def __init__(self, interval=None, device='simulated', seed=None):
+        super().__init__(interval)
+        self.device = device
+        self._random = random.Random(seed)
+        self._co2 = 600.0
+
+    def device_ids(self):
+        return [self.device]
+
+    def sample(self):
+        # A daily temperature cycle, and CO2 as a random walk pulled back
+        # towards 600 ppm
+        day = math.sin(2 * math.pi * (time.time() % 86400) / 86400)
+        self._co2 += self._random.gauss(0, 25) + (600 - self._co2) * 0.05
+        self._co2 = min(max(self._co2, 400), 5000)
+        return {self.device: {
+            'temperature': round(21 + 2 * day + self._random.gauss(0, 0.1), 2),
+            'co2': round(self._co2),
+            'humidity': round(45 - 5 * day + self._random.gauss(0, 0.5), 2),
+        }}
+
+
+BACKENDS = {
+    'co2': CO2Sensor,
+    'dht22': DHT22Sensor,
+    'simulated': SimulatedSensor,
+}
+
+
+def create(spec):
+    # Sensor instance for 'name' or 'name:key=value,...'
+    name, _, options = spec.partition(':')
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown sensor {name!r}, expected one of {', '.join(BACKENDS)}")
+    kwargs = dict(option.split('=', 1) for option in options.split(',') if option)
+    return BACKENDS[name](**kwargs)
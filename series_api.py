@@ -0,0 +1,152 @@
+# Compact time series for client-side charting (/api/series).
+#
+# Times are sent as the first epoch second plus per-point deltas, values as
+# float32 columns. Two encodings share the same layout:
+#
+#   format=json  {"metric", "resolution", "start", "time": [deltas...],
+#                 "mean": [...], "min": [...], "max": [...]}
+#   format=bin   little-endian, 20 byte header then the columns:
+#                  4s  magic b'CO2S'
+#                  B   version (2; 1 sent offsets from start instead of deltas)
+#                  B   flags (bit 0: min/max columns follow mean)
+#                  B   resolution (0 raw, 1 hourly, 2 daily, 3 live)
+#                  x   padding
+#                  I   point count n
+#                  d   start, epoch seconds
+#                  n * uint32 time deltas to the previous point (first is 0)
+#                  n * float32 mean [, n * float32 min, n * float32 max]
+#
+# min/max are only sent for rollups; for raw and live rows they equal the mean.
+# resolution=live serves the in-memory ring of raw device readings
+# (ring_buffer.RecentReadings) instead of the database.
+# Responses are gzip'd when the client accepts it.
+
+import gzip
+import json
+import math
+import struct
+import time
+
+from flask import Response, request
+
+import storage
+
+MAGIC = b'CO2S'
+VERSION = 2
+HEADER = struct.Struct('<4sBBBxId')
+RESOLUTION_CODES = {'raw': 0, 'hourly': 1, 'daily': 2, 'live': 3}
+FLAG_MIN_MAX = 0x01
+# Resolutions of single readings, sent without min/max columns
+POINT_RESOLUTIONS = ('raw', 'live')
+
+# A chart rarely has more horizontal pixels than this
+DEFAULT_POINTS = 1000
+
+# Requested times are clamped to this range of epoch seconds, which SQLite
+# and the uint32 deltas can hold
+MAX_TIME = 2 ** 32 - 1
+
+# Smaller payloads are not worth the CPU of compressing them
+GZIP_MIN_BYTES = 1024
+
+
+def time_deltas(times):
+    # (start, deltas): the first time and the differences of consecutive
+    # times, which are mostly equal and so compress well
+    import numpy as np
+
+    start = int(times[0]) if len(times) else 0
+    return start, np.diff(times, prepend=start)
+
+
+def encode_binary(metric, resolution, times, means, lows, highs):
+    start, deltas = time_deltas(times)
+    with_range = resolution not in POINT_RESOLUTIONS
+    flags = FLAG_MIN_MAX if with_range else 0
+    columns = [deltas.astype('<u4'), means.astype('<f4')]
+    if with_range:
+        columns += [lows.astype('<f4'), highs.astype('<f4')]
+    header = HEADER.pack(MAGIC, VERSION, flags, RESOLUTION_CODES[resolution], len(times), start)
+    return header + b''.join(column.tobytes() for column in columns)
+
+
+def encode_json(metric, resolution, times, means, lows, highs):
+    import numpy as np
+
+    def rounded(values):
+        # float32 -> float64 first, or tolist() gives 412.29998779296875
+        return np.round(values.astype(np.float64), 2).tolist()
+
+    start, deltas = time_deltas(times)
+    data = {'metric': metric, 'resolution': resolution, 'start': start,
+            'time': deltas.tolist(), 'mean': rounded(means)}
+    if resolution not in POINT_RESOLUTIONS:
+        data['min'] = rounded(lows)
+        data['max'] = rounded(highs)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def live_series(recent, metric, start, end, device=None):
+    # (times, means, lows, highs) arrays from the in-memory ring buffer, whose
+    # keys are metric names or (device_id, metric) pairs
+    import numpy as np
+
+    key = metric if device is None else (device, metric)
+    times, values = recent.snapshot(key, time.time() - start)
+    times = np.frombuffer(times, dtype=np.float64)
+    values = np.frombuffer(values, dtype=np.float64).astype(np.float32)
+    in_range = times <= end
+    times = times[in_range].astype(np.int64)
+    values = values[in_range]
+    return times, values, values, values
+
+
+def series_response(recent=None):
+    # /api/series?metric=co2&hours=24[&start=&end=][&resolution=raw|hourly|daily|live]
+    #            [&device=ID][&points=N][&format=json|bin]
+    # points limits the series to about N points (LTTB); 0 sends every row.
+    # Without device, all monitors are combined.
+    metric = request.args.get('metric', 'co2')
+    if metric not in storage.METRICS:
+        return Response(f"Unknown metric {metric!r}", status=400, mimetype='text/plain')
+    device = request.args.get('device') or None
+    end = request.args.get('end', time.time(), type=float)
+    start = request.args.get('start', type=float)
+    if start is None:
+        start = end - request.args.get('hours', 24, type=float) * 3600
+    if not (math.isfinite(start) and math.isfinite(end)):
+        return Response("start, end and hours must be finite", status=400, mimetype='text/plain')
+    start = min(max(start, 0), MAX_TIME)
+    end = min(max(end, 0), MAX_TIME)
+    resolution = request.args.get('resolution') or None
+    if resolution == 'auto':
+        resolution = None
+    points = request.args.get('points', DEFAULT_POINTS, type=int)
+    output = request.args.get('format', 'json')
+
+    # Imported here so numpy is only loaded once the API is used
+    from downsample import downsample
+
+    if resolution == 'live' and recent is not None:
+        series = live_series(recent, metric, start, end, device)
+    else:
+        try:
+            resolution, *series = storage.query_series_arrays(metric, start, end, resolution=resolution,
+                                                              device=device)
+        except ValueError as error:
+            return Response(str(error), status=400, mimetype='text/plain')
+    if points:
+        series = downsample(*series, n_out=points)
+
+    if output == 'bin':
+        body = encode_binary(metric, resolution, *series)
+        response = Response(body, mimetype='application/octet-stream')
+    else:
+        body = encode_json(metric, resolution, *series)
+        response = Response(body, mimetype='application/json')
+
+    if len(body) >= GZIP_MIN_BYTES and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,96 @@
+# Latest values shared between the ingest process and the web workers.
+#
+# ingest.py owns the sensors and publishes a small JSON document after
+# every sample; any number of web workers read it. The document lives in a
+# memory-mapped file (in /dev/shm where available), so a read is a copy
+# out of shared memory without a system call or a lock:
+#
+#   header: version (uint32), payload length (uint32), crc32 of the payload
+#   payload: UTF-8 JSON
+#
+# The writer bumps the version with every publish. Readers copy header
+# and payload and retry if the CRC does not match, i.e. if they raced
+# with a write.
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+HEADER = struct.Struct('<III')
+SIZE = 64 * 1024
+
+DEFAULT_PATH = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                            'co2-monitor-state')
+
+# Attempts to get a consistent copy while the writer is busy
+READ_ATTEMPTS = 10
+
+
+class SharedState:
+
+    def __init__(self, path=DEFAULT_PATH, writable=False):
+        self.path = path
+        self.writable = writable
+        self.version = 0
+        self._map = None
+
+    def _open(self):
+        if self._map is not None:
+            return True
+        if self.writable:
+            # Never truncated or replaced: readers keep their mapping when
+            # the ingest process restarts
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < SIZE:
+                    os.ftruncate(fd, SIZE)
+                self._map = mmap.mmap(fd, SIZE)
+            finally:
+                os.close(fd)
+            self.version = HEADER.unpack_from(self._map)[0]
+            return True
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            # ingest.py has not started yet
+            return False
+        try:
+            if os.fstat(fd).st_size < SIZE:
+                return False
+            self._map = mmap.mmap(fd, SIZE, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        return True
+
+    def publish(self, state):
+        # state: anything json.dumps() takes
+        self._open()
+        payload = json.dumps(state, separators=(',', ':')).encode()
+        if HEADER.size + len(payload) > SIZE:
+            raise ValueError(f"State of {len(payload)} bytes does not fit in {SIZE} bytes")
+        self.version = (self.version + 1) & 0xffffffff
+        self._map[HEADER.size:HEADER.size + len(payload)] = payload
+        HEADER.pack_into(self._map, 0, self.version, len(payload), zlib.crc32(payload))
+
+    def read(self):
+        # (version, state), or (0, None) while nothing was published yet
+        if not self._open():
+            return 0, None
+        for _ in range(READ_ATTEMPTS):
+            version, length, crc = HEADER.unpack_from(self._map)
+            if version == 0 or length > SIZE - HEADER.size:
+                return 0, None
+            payload = self._map[HEADER.size:HEADER.size + length]
+            if zlib.crc32(payload) == crc and HEADER.unpack_from(self._map)[0] == version:
+                return version, json.loads(payload)
+            time.sleep(0)
+        return 0, None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
@@ -0,0 +1,57 @@
+# Startup timing helpers.
+#
+#   python3 startup.py monitor_app
+#
+# prints how long importing a module takes, broken down by the modules it
+# imports (from `python -X importtime`), so slow imports on the Pi are easy
+# to spot. mark() records named phases of the running process.
+
+import sys
+import time
+
+_start = time.perf_counter()
+
+# phase -> seconds since this module was first imported
+timings = {}
+
+
+def mark(phase):
+    timings[phase] = time.perf_counter() - _start
+    return timings[phase]
+
+
+def import_times(module):
+    # Imports `module` in a fresh interpreter and returns a list of
+    # (name, depth, self seconds, cumulative seconds) in import order.
+    # re and subprocess are imported here to keep this module cheap to import.
+    import re
+    import subprocess
+
+    line_pattern = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        match = line_pattern.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((name, (len(indent) - 1) // 2, int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    if result.returncode != 0:
+        print(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import failed")
+    return rows
+
+
+def print_import_report(module, top=20):
+    rows = import_times(module)
+    total = next((r[3] for r in rows if r[0] == module), None)
+    if total is not None:
+        print(f"import {module}: {total * 1000:.0f} ms")
+    # Modules imported directly by `module`, slowest first
+    direct = sorted((r for r in rows if r[1] == 1), key=lambda r: r[3], reverse=True)
+    print("%-40s %12s %12s" % ("module", "self ms", "total ms"))
+    for name, _, self_s, cumulative_s in direct[:top]:
+        print("%-40s %12.1f %12.1f" % (name, self_s * 1000, cumulative_s * 1000))
+
+
+if __name__ == '__main__':
+    print_import_report(sys.argv[1] if len(sys.argv) > 1 else 'monitor_app')